@@ -27,10 +27,12 @@ try:
     proxy_https=None
     no_proxy=None
     proxy_port=None
+    proxy_cache=None
     if server_config.get("proxy-setup") is not None:
         proxy_http=server_config["proxy-setup"].get("http-proxy")
         proxy_https=server_config["proxy-setup"].get("https-proxy")
         no_proxy=server_config["proxy-setup"].get("no-proxy")
+        proxy_cache=server_config["proxy-setup"].get("local-cache")
         proxy_info = proxy_http.split(":")
         if len(proxy_info) == 3:
             proxy_port = proxy_info[2]
@@ -71,9 +73,21 @@ try:
         ),
     )
 
+    build_cache = server_config.get("build-cache")
+    lifecycle_rules = None
+    if build_cache is not None:
+        # The BuildKit S3 cache is not in the cache-sync.sh manifest, its blobs are
+        # touched when reused so expiring them only drops layers no build uses
+        lifecycle_rules = [aws.s3.BucketLifecycleRuleArgs(
+            enabled=True,
+            prefix="build-cache/buildkit/",
+            expiration=aws.s3.BucketLifecycleRuleExpirationArgs(days=build_cache.get("buildkit-expiration-days", 14)),
+        )]
+
     config_bucket = aws.s3.Bucket(
         "configuration-bucket",
         acl="private",
+        lifecycle_rules=lifecycle_rules,
         tags={
             "Environment": stack,
             "Name": server_name,
@@ -117,6 +131,27 @@ Resources:
         "deployer-key-object", bucket=config_bucket.id, source=deployerFile
     )
     
+    # ci-runner.sh stores ci results for reuse by runs of the same tree, and never deletes them
+    write_prefixes = {"ci-results": ["s3:PutObject"]}
+    if build_cache is not None:
+        # cache-sync.sh deletes evicted objects
+        write_prefixes["build-cache"] = ["s3:PutObject", "s3:DeleteObject"]
+        cacheSyncFile = pulumi.FileAsset("./cache-sync.sh")
+        aws.s3.BucketObject(
+            "cache-sync-object", bucket=config_bucket.id, key="cache-sync.sh", source=cacheSyncFile
+        )
+
+    telemetry = server_config.get("telemetry")
+    # Log groups the CloudWatch agent writes to
+    log_groups = []
+    if telemetry is not None:
+        # EMF records sent by the telemetry agent
+        log_groups.append("ec2-dev-telemetry")
+        telemetryAgentFile = pulumi.FileAsset("./telemetry-agent.py")
+        aws.s3.BucketObject(
+            "telemetry-agent-object", bucket=config_bucket.id, key="telemetry-agent.py", source=telemetryAgentFile
+        )
+
     permissions_boundary_arn = None
     iam_role = None
     if roles_config:
@@ -128,7 +163,8 @@ Resources:
         roles = roles.RolesComponent(
             "roles",
             roles.RolesComponentArgs(
-                config_bucket, policies, permissions_boundary_arn=permissions_boundary_arn
+                config_bucket, policies, permissions_boundary_arn=permissions_boundary_arn,
+                write_prefixes=write_prefixes, log_groups=log_groups
             ),
         )
         iam_role = roles.base_instance_role
@@ -164,6 +200,7 @@ Resources:
         "proxy_http": proxy_http,
         "proxy_https": proxy_https,
         "no_proxy": no_proxy,
+        "proxy_cache": proxy_cache,
         "stack_name": stack,
         "debug": debug_flag,
         "tags": {
@@ -172,6 +209,7 @@ Resources:
         },
         "region": region,
         "ssh_access": ssh_access,
+        "config_bucket": config_bucket.id,
     }
 
     depends_on = []
@@ -191,10 +229,24 @@ Resources:
     if instance_type is not None:
         server_args["instance_type"] = instance_type
 
+    registry_mirror = server_config.get("registry-mirror")
+    if registry_mirror is not None:
+        server_args["registry_mirror"] = registry_mirror
+
+    if build_cache is not None:
+        server_args["build_cache"] = build_cache
+
+    if telemetry is not None:
+        server_args["telemetry"] = telemetry
+
     user_data_file = app_config.get("user-data-file")
     if user_data_file is not None:
         server_args["user_data_file"] = user_data_file
 
+    user_data_parts = app_config.get("user-data-parts")
+    if user_data_parts is not None:
+        server_args["user_data_parts"] = user_data_parts
+
     server = server.ServerComponent(server_name, **server_args)
 
     pulumi.export('instance', server.instance.id)
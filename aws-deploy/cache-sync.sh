@@ -0,0 +1,321 @@
+#!/bin/bash
+
+# Utility for sharing build caches between instances via the stack's configuration bucket
+# Version: 1.0
+
+set -euo pipefail
+export LC_ALL=C
+
+tempfiles=( )
+cleanup() {
+  rm -rf "${tempfiles[@]}"
+}
+trap cleanup 0
+
+function usage()
+{
+    echo "usage ${0} [--debug] restore|push|prune|buildx-args"
+    echo "This script restores and saves build caches to a content addressed store in an S3 bucket"
+    echo "restore copies cache shards that differ from the local copy from the store"
+    echo "push uploads changed cache shards to the store and evicts least recently used shards"
+    echo "prune evicts least recently used shards until the store is within its size cap"
+    echo "buildx-args prints docker buildx --cache-from/--cache-to options for the BuildKit S3 cache"
+    echo "Environment:"
+    echo "  CONFIG_BUCKET       bucket holding the store, required"
+    echo "  CACHE_PREFIX        key prefix of the store, defaults to build-cache"
+    echo "  CACHE_MAX_MB        total size cap of the store, defaults to 10240"
+    echo "  CACHE_MAX_SHARD_MB  shards larger than this are not pushed, defaults to 1024"
+    echo "  CACHE_DIRS          space separated <dir relative to \$HOME>:<shard depth or packs> list,"
+    echo "                      defaults to \"go/pkg/mod/cache/download:2 .cache/go-build:packs\""
+    echo "  CACHE_GRACE_MINUTES unreferenced objects younger than this are kept, defaults to 60"
+    echo "  CACHE_S3_ENDPOINT   alternative S3 endpoint, e.g. a local S3 stand-in"
+}
+
+function args() {
+  command=""
+  arg_list=( "$@" )
+  arg_count=${#arg_list[@]}
+  arg_index=0
+  while (( arg_index < arg_count )); do
+    case "${arg_list[${arg_index}]}" in
+          "--debug") set -x;;
+               "-h") usage; exit;;
+           "--help") usage; exit;;
+               "-?") usage; exit;;
+        *) if [ "${arg_list[${arg_index}]:0:2}" == "--" ];then
+               echo "invalid argument: ${arg_list[${arg_index}]}"
+               usage; exit 1
+           fi;
+           command="${arg_list[${arg_index}]}";;
+    esac
+    (( arg_index+=1 ))
+  done
+  if [ -z "$command" ]; then
+    usage; exit 1
+  fi
+}
+
+function s3api() {
+  aws ${CACHE_S3_ENDPOINT:+--endpoint-url $CACHE_S3_ENDPOINT} s3api "$@"
+}
+
+function s3() {
+  aws ${CACHE_S3_ENDPOINT:+--endpoint-url $CACHE_S3_ENDPOINT} s3 "$@"
+}
+
+# List shards as "<shard name> <fingerprint>" lines. A shard is a directory at the
+# configured depth below a cache directory. Go module downloads and go build cache
+# entries are named by version or content hash, so names and sizes identify content.
+# The archive stores the shard's path, so the path is part of the fingerprint too.
+function local_shards() {
+  local entry dir depth state
+  for entry in $CACHE_DIRS; do
+    dir="${entry%:*}"
+    depth="${entry##*:}"
+    if [ ! -d "$HOME/$dir" ]; then
+      continue
+    fi
+    if [ "$depth" == "packs" ]; then
+      # No pack state until the first push or restore of a pack
+      state=$(pack_state "$dir")
+      if [ -d "$state" ]; then
+        ls $state | sed -e "s#.*#$dir\#& &#"
+      fi
+      continue
+    fi
+    (cd $HOME && find "$dir" -mindepth $depth -maxdepth $depth -type d) | sort | while read -r shard; do
+      fingerprint=$( (echo "$shard"; cd $HOME/$shard && find . -type f ! -name '*.lock' -printf '%P %s\n' | sort) | sha256sum | cut -f1 -d' ')
+      echo "$shard $fingerprint"
+    done
+  done
+}
+
+# Packs hold the entries of a cache directory that were not in the store when they
+# were pushed. Go build cache entries are named by content hash and never change, so
+# a push only uploads the entries added since the last one. The names of the entries
+# in each pack this instance has pushed or restored are kept in its pack state.
+function pack_state() {
+  echo "$HOME/.cache/cache-sync/${1//\//_}"
+}
+
+# Upload an archive unless the content addressed object is already in the store,
+# another instance may have uploaded it
+function upload_object() {
+  local archive=$1
+  local fingerprint=$2
+  if ! s3api head-object --bucket $CONFIG_BUCKET --key $CACHE_PREFIX/objects/$fingerprint.tar.gz >/dev/null 2>&1; then
+    s3 cp --quiet $archive s3://$CONFIG_BUCKET/$CACHE_PREFIX/objects/$fingerprint.tar.gz
+    (( pushed+=1 ))
+  fi
+}
+
+function push_packs() {
+  local dir=$1
+  local now=$2
+  local state=$(pack_state "$dir")
+  local entries=$(mktemp)
+  local known=$(mktemp)
+  local chunks=$(mktemp -d)
+  tempfiles+=( "$entries" "$known" "$chunks" )
+  mkdir -p $state
+
+  # Entries of packs evicted from the store are pushed again if still present
+  ls $state | while read -r fingerprint; do
+    if ! jq -e --arg s "$dir#$fingerprint" '.shards | has($s)' $manifest >/dev/null; then
+      rm -f $state/$fingerprint
+    fi
+  done
+
+  # Split the new entries into packs of up to the shard size cap before compression
+  (cd $HOME && find "$dir" -mindepth 2 -type f ! -name '*.lock' -printf '%p %s\n') | sort > $entries
+  cat $state/* > $known 2>/dev/null || true
+  awk 'FILENAME == ARGV[1] { known[$1]; next } !($1 in known)' $known $entries \
+    | awk -v cap=$(( CACHE_MAX_SHARD_MB * 1024 * 1024 )) -v out=$chunks/ '
+      total > 0 && total + $2 > cap { n++; total = 0 }
+      { total += $2; print > (out (n + 0)) }'
+
+  for chunk in $chunks/*; do
+    [ -f "$chunk" ] || continue
+    fingerprint=$( (echo "$dir"; cat $chunk) | sha256sum | cut -f1 -d' ')
+    archive=$(mktemp)
+    tempfiles+=( "$archive" )
+    cut -f1 -d' ' $chunk | tar czf $archive -C $HOME -T -
+    size=$(stat -c %s $archive)
+    if (( size > CACHE_MAX_SHARD_MB * 1024 * 1024 )); then
+      echo "Skipping $(wc -l < $chunk) entries of $dir, $size bytes exceeds shard size cap"
+      rm -f $archive
+      continue
+    fi
+    upload_object $archive $fingerprint
+    rm -f $archive
+    cut -f1 -d' ' $chunk > $state/$fingerprint
+    jq --arg s "$dir#$fingerprint" --arg k "$fingerprint" --argjson z $size --argjson u $now \
+      '.shards[$s] = {"key": $k, "size": $z, "used": $u}' $manifest > $manifest.new
+    mv $manifest.new $manifest
+  done
+}
+
+function get_manifest() {
+  manifest=$(mktemp)
+  tempfiles+=( "$manifest" )
+  if ! s3 cp --quiet s3://$CONFIG_BUCKET/$CACHE_PREFIX/manifest.json $manifest 2>/dev/null; then
+    echo '{"shards": {}}' > $manifest
+  fi
+}
+
+# Other instances may have pushed since the manifest was read, merge their entries in
+# rather than overwriting them, keeping the most recently used entry for each shard
+function merge_manifest() {
+  local ours=$manifest
+  get_manifest
+  jq -s '.[0].shards as $remote | {"shards": ($remote + (.[1].shards
+    | with_entries(select(.value.used >= ($remote[.key].used // 0)))))}' $manifest $ours > $manifest.new
+  mv $manifest.new $manifest
+}
+
+function put_manifest() {
+  s3 cp --quiet $manifest s3://$CONFIG_BUCKET/$CACHE_PREFIX/manifest.json
+}
+
+function restore() {
+  get_manifest
+  local wanted=$(mktemp)
+  tempfiles+=( "$wanted" )
+  jq -r '.shards | to_entries[] | "\(.key) \(.value.key)"' $manifest | sort > $wanted
+  local_shards | sort | comm -23 $wanted - > $wanted.missing
+  tempfiles+=( "$wanted.missing" )
+
+  local count=$(wc -l < $wanted.missing)
+  echo "Restoring $count cache shards from s3://$CONFIG_BUCKET/$CACHE_PREFIX"
+  export -f s3 pack_state
+  export CONFIG_BUCKET CACHE_PREFIX CACHE_S3_ENDPOINT HOME
+  # Packs are merged into the cache directory and recorded in the pack state.
+  # Stale shards are replaced rather than merged so deleted entries do not linger.
+  # A concurrent push can evict a shard after the manifest was read, skip those.
+  cat $wanted.missing | xargs -r -P 8 -L 1 bash -c '
+    if [[ "$0" == *#* ]]; then
+      state=$(pack_state "${0%#*}")
+      mkdir -p "$state"
+      archive=$(mktemp)
+      if s3 cp --quiet "s3://$CONFIG_BUCKET/$CACHE_PREFIX/objects/$1.tar.gz" $archive 2>/dev/null; then
+        # Entries are immutable, so overwriting an existing one is harmless
+        tar xzf $archive -C "$HOME" && tar tzf $archive > "$state/$1"
+      else
+        echo "Skipping $0, no longer in the store"
+      fi
+      rm -f $archive
+      exit 0
+    fi
+    rm -rf "$HOME/$0"
+    mkdir -p "$(dirname "$HOME/$0")"
+    { s3 cp --quiet "s3://$CONFIG_BUCKET/$CACHE_PREFIX/objects/$1.tar.gz" - | tar xzf - -C "$HOME"; } 2>/dev/null \
+      || echo "Skipping $0, no longer in the store"
+  '
+}
+
+function push() {
+  get_manifest
+  local now=$(date +%s)
+  local shards=$(mktemp)
+  tempfiles+=( "$shards" )
+  pushed=0
+  local entry
+  for entry in $CACHE_DIRS; do
+    if [ "${entry##*:}" == "packs" ] && [ -d "$HOME/${entry%:*}" ]; then
+      push_packs "${entry%:*}" $now
+    fi
+  done
+  local_shards > $shards
+
+  while read -r shard fingerprint; do
+    current=$(jq -r --arg s "$shard" '.shards[$s].key // ""' $manifest)
+    size=$(jq -r --arg s "$shard" '.shards[$s].size // 0' $manifest)
+    if [ "$current" != "$fingerprint" ] && [[ "$shard" != *#* ]]; then
+      archive=$(mktemp)
+      tempfiles+=( "$archive" )
+      tar czf $archive -C $HOME "$shard"
+      size=$(stat -c %s $archive)
+      if (( size > CACHE_MAX_SHARD_MB * 1024 * 1024 )); then
+        echo "Skipping $shard, $size bytes exceeds shard size cap"
+        rm -f $archive
+        continue
+      fi
+      upload_object $archive $fingerprint
+      rm -f $archive
+    fi
+    jq --arg s "$shard" --arg k "$fingerprint" --argjson z $size --argjson u $now \
+      '.shards[$s] = {"key": $k, "size": $z, "used": $u}' $manifest > $manifest.new
+    mv $manifest.new $manifest
+  done < $shards
+
+  echo "Pushed $pushed cache shards to s3://$CONFIG_BUCKET/$CACHE_PREFIX"
+  merge_manifest
+  evict
+  put_manifest
+  delete_unreferenced
+}
+
+# Drop least recently used shards from the manifest until the store is within its size cap
+function evict() {
+  jq --argjson cap $(( CACHE_MAX_MB * 1024 * 1024 )) '
+    .shards |= (to_entries | sort_by(-.value.used)
+      | reduce .[] as $e ({"total": 0, "keep": []};
+          if .total + $e.value.size <= $cap then .total += $e.value.size | .keep += [$e] else . end)
+      | .keep | from_entries)' $manifest > $manifest.new
+  mv $manifest.new $manifest
+}
+
+# Objects uploaded within the grace period may be referenced by a manifest another
+# instance is about to write, so only older unreferenced objects are deleted
+function delete_unreferenced() {
+  local referenced=$(mktemp)
+  tempfiles+=( "$referenced" )
+  jq -r '.shards[].key + ".tar.gz"' $manifest | sort -u > $referenced
+  s3api list-objects-v2 --bucket $CONFIG_BUCKET --prefix $CACHE_PREFIX/objects/ --query 'Contents[]' --output json \
+    | jq -r --argjson cutoff $(( $(date +%s) - CACHE_GRACE_MINUTES * 60 )) '.[]?
+      | select((.LastModified | sub("\\.[0-9]+"; "") | sub("\\+00:00$"; "Z") | fromdateiso8601) < $cutoff) | .Key' \
+    | sed -e "s#^$CACHE_PREFIX/objects/##" | sort | comm -23 - $referenced \
+    | while read -r object; do
+      s3 rm --quiet s3://$CONFIG_BUCKET/$CACHE_PREFIX/objects/$object
+    done
+}
+
+function prune() {
+  get_manifest
+  evict
+  put_manifest
+  delete_unreferenced
+}
+
+function buildx_args() {
+  local attrs="region=$AWS_REGION,bucket=$CONFIG_BUCKET,prefix=$CACHE_PREFIX/buildkit/"
+  if [ -n "${CACHE_S3_ENDPOINT:-}" ]; then
+    attrs="$attrs,endpoint_url=$CACHE_S3_ENDPOINT,use_path_style=true"
+  fi
+  # No credentials are passed, the ec2-dev builder uses host networking so BuildKit
+  # gets the instance role's credentials from instance metadata. BuildKit touches
+  # reused blobs daily (touch_refresh), the bucket expires the untouched ones.
+  echo "--cache-from type=s3,$attrs --cache-to type=s3,$attrs,mode=max"
+}
+
+args "$@"
+
+if [ -z "${CONFIG_BUCKET:-}" ]; then
+  echo "CONFIG_BUCKET must be set"
+  exit 1
+fi
+
+CACHE_PREFIX=${CACHE_PREFIX:-build-cache}
+CACHE_MAX_MB=${CACHE_MAX_MB:-10240}
+CACHE_MAX_SHARD_MB=${CACHE_MAX_SHARD_MB:-1024}
+CACHE_DIRS=${CACHE_DIRS:-"go/pkg/mod/cache/download:2 .cache/go-build:packs"}
+CACHE_GRACE_MINUTES=${CACHE_GRACE_MINUTES:-60}
+CACHE_S3_ENDPOINT=${CACHE_S3_ENDPOINT:-}
+
+case "$command" in
+  "restore") restore;;
+  "push") push;;
+  "prune") prune;;
+  "buildx-args") buildx_args;;
+  *) echo "invalid command: $command"; usage; exit 1;;
+esac
@@ -22,15 +22,21 @@ error() {
     echo "Error on or near line ${parent_lineno}; exiting with status ${code}"
   fi
   set_check_completed 1
+  record_ci_span "${code}"
+  # A failed ci script still leaves build caches worth sharing
+  if [ -n "${ci_start:-}" ]; then
+    push_build_cache
+  fi
   exit "${code}"
 }
 trap 'error ${LINENO}' ERR
 
 function usage()
 {
-    echo "usage ${0} [--debug] [--comment] --pull-request <pr number> --commit-sha <commit sha> --url <log file url> "
+    echo "usage ${0} [--debug] [--comment] [--no-cache] --pull-request <pr number> --commit-sha <commit sha> --url <log file url> "
     echo "This script will look for new PRs and run the configured ci script against the PR branch"
     echo "--comment option causes comments to be written to PR containing test log"
+    echo "--no-cache option runs the ci script even if the same tree has already passed"
     echo "--pull-request is the pull request number"
     echo "--commit-sha is the commit sha"
     echo "--url is the URL to use in the check status"
@@ -39,6 +45,7 @@ function usage()
 function args() {
   debug=""
   comment=""
+  no_cache=""
   url=""
   arg_list=( "$@" )
   arg_count=${#arg_list[@]}
@@ -47,6 +54,7 @@ function args() {
     case "${arg_list[${arg_index}]}" in
           "--debug") set -x; debug="--debug";export DEBUG=1;;
           "--comment") comment="--comment";;
+          "--no-cache") no_cache="--no-cache";;
           "--pull-request") (( arg_index+=1 ));pr="${arg_list[${arg_index}]}";;
           "--commit-sha") (( arg_index+=1 ));commit_sha="${arg_list[${arg_index}]}";;
           "--url") (( arg_index+=1 ));url="${arg_list[${arg_index}]}";;
@@ -67,16 +75,23 @@ function run_ci() {
   clone_repo
   git checkout $commit_sha
   if [ -f "$CI_SCRIPT" ]; then
-    set_check_running
-    echo "Executing CI script: $CI_SCRIPT"
-    echo "Run starting at `date`"
-    export PR_NUM=$pr
-    $CI_SCRIPT
-    result=$?
-    if [ -n "$comment" ] ; then
-      commentPR $log_file
+    ci_cache_key
+    if ! get_cached_result; then
+      set_check_running
+      echo "Executing CI script: $CI_SCRIPT"
+      echo "Run starting at `date`"
+      export PR_NUM=$pr
+      ci_start=$(date +%s)
+      $CI_SCRIPT
+      result=$?
+      if [ -n "$comment" ] ; then
+        commentPR $log_file
+      fi
+      set_check_completed $result
+      record_ci_span $result
+      put_cached_result $result
+      push_build_cache
     fi
-    set_check_completed $result
   else
     echo "no $CI_SCRIPT file found in PR"
     set_check_completed 1
@@ -85,6 +100,69 @@ function run_ci() {
   echo "Run completed at `date`"
 }
 
+# Results are keyed on the tree rather than the commit, so rebases, reworded commits
+# and re-requested checks of an already tested tree reuse the result
+function ci_cache_key() {
+  local var
+  cache_key=$( (
+    echo "tree=$(git rev-parse HEAD^{tree})"
+    echo "script=$(sha256sum < $CI_SCRIPT | cut -f1 -d' ')"
+    echo "repo=$GITHUB_ORG_REPO"
+    echo "context=$CI_ID"
+    for var in ${CI_CACHE_ENV:-}; do
+      echo "$var=${!var:-}"
+    done
+  ) | sha256sum | cut -f1 -d' ')
+}
+
+function get_cached_result() {
+  local record
+  if [ -n "$no_cache" ]; then
+    return 1
+  fi
+  record=$(mktemp)
+  tempfiles+=( "$record" )
+  if [ -n "${CONFIG_BUCKET:-}" ]; then
+    aws s3 cp --quiet s3://$CONFIG_BUCKET/ci-results/$cache_key.json $record 2>/dev/null || return 1
+  else
+    cp $ci_cache_dir/$cache_key.json $record 2>/dev/null || return 1
+  fi
+  echo "Tree already tested by commit $(jq -r '.commit' $record), reusing its result"
+  url=$(jq -r '.url' $record)
+  set_check_completed $(jq -r '.result' $record)
+}
+
+# Only successes are stored, so a flaky failure is retried by the next run
+function put_cached_result() {
+  local result=$1
+  local record
+  if [ "$result" != "0" ]; then
+    return
+  fi
+  record=$(mktemp)
+  tempfiles+=( "$record" )
+  jq -n --arg commit "$commit_sha" --arg pr "$pr" --arg url "$url" --argjson result $result \
+    '{"commit": $commit, "pr": $pr, "url": $url, "result": $result, "date": (now | todate)}' > $record
+  if [ -n "${CONFIG_BUCKET:-}" ]; then
+    aws s3 cp --quiet $record s3://$CONFIG_BUCKET/ci-results/$cache_key.json || echo "failed to store ci result"
+  else
+    mkdir -p $ci_cache_dir && cp $record $ci_cache_dir/$cache_key.json || echo "failed to store ci result"
+  fi
+}
+
+function record_ci_span() {
+  local result=$1
+  if [ -n "$ci_start" ] && command -v ec2-dev-telemetry >/dev/null; then
+    ec2-dev-telemetry span --name ci --pr "$pr" --commit "$commit_sha" --result "$result" --start $ci_start || echo "failed to record ci span"
+  fi
+}
+
+function push_build_cache() {
+  if [ -n "${CONFIG_BUCKET:-}" ] && command -v cache-sync.sh >/dev/null; then
+    cache-sync.sh $debug push || echo "failed to push build cache"
+  fi
+}
+
 function clone_repo() {
   TMPDIR=$(mktemp -d)
   tempfiles+=( "$TMPDIR" )
@@ -94,34 +172,42 @@ function clone_repo() {
     rm -rf $REPO
   fi
   git lfs install --skip-repo
-  git clone https://$GITHUB_TOKEN@github.com/$GITHUB_ORG_REPO.git
+  git clone ${github_url/:\/\//://$GITHUB_TOKEN@}/$GITHUB_ORG_REPO.git
   cd $REPO
 }
 
 function commentPR() {
   data_file=$1
   data=$(sed -e 's/\"/\\\"/g' $data_file | awk '{printf "%s\\n", $0}')
-  curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" https://api.github.com/repos/$GITHUB_ORG_REPO/issues/$pr/comments \
+  curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" $github_api_url/repos/$GITHUB_ORG_REPO/issues/$pr/comments \
     -d "{\"state\":\"COMMENTED\", \"body\": \"$data\"}"
 }
 
 function set_check_running() {
-  curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" https://api.github.com/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
+  curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" $github_api_url/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
     -d "{\"context\":\"$CI_ID\",\"description\": \"ci run started\",\"state\":\"pending\", \"target_url\": \"$url\"}"
 }
 
 function set_check_completed() {
   local result=$1
   if [ "$result" == "0" ]; then
-    curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" https://api.github.com/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
+    curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" $github_api_url/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
       -d "{\"context\":\"$CI_ID\",\"description\": \"ci run completed successfully\",\"state\":\"success\", \"target_url\": \"$url\"}"
   else
-    curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" https://api.github.com/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
+    curl $curl_proxy_opt -s -X POST -H "Authorization: token $GITHUB_TOKEN" -H "Accept: application/vnd.github.v3+json" $github_api_url/repos/$GITHUB_ORG_REPO/statuses/$commit_sha \
       -d "{\"context\":\"$CI_ID\",\"description\": \"ci run failed\",\"state\":\"failure\", \"target_url\": \"$url\"}"
   fi
 }
 
 log_path=""
+ci_start=""
+cache_key=""
+ci_cache_dir=${CI_CACHE_DIR:-$HOME/.cache/ec2-dev/ci-results}
+
+# GitHub endpoints can be overridden to run against a stand-in, e.g. in bench/bootstrap_bench.py
+github_url=${GITHUB_URL:-https://github.com}
+github_api_url=${GITHUB_API_URL:-https://api.github.com}
+curl_proxy_opt=${curl_proxy_opt:-}
 
 # Set AWS creds
 
@@ -4,15 +4,20 @@ import json
 
 
 class RolesComponentArgs:
-    def __init__(self, configS3Bucket, policies, permissions_boundary_arn=None):
+    def __init__(self, configS3Bucket, policies, permissions_boundary_arn=None, write_prefixes=None, log_groups=None):
         self.configS3Bucket = configS3Bucket
         self.policies = policies
         self.permissions_boundary_arn = permissions_boundary_arn
+        self.write_prefixes = write_prefixes
+        self.log_groups = log_groups
 
 
 class RolesComponent(pulumi.ComponentResource):
     def __init__(self, name, args: RolesComponentArgs, opts=None):
         super().__init__("pkg:index:RolesComponent", name, None, opts)
+        # Key prefix to the actions allowed on objects under it
+        write_prefixes = args.write_prefixes or {}
+        log_groups = args.log_groups or []
         inline_policies = [
                 aws.iam.RoleInlinePolicyArgs(
                     name="configS3Bucket",
@@ -39,6 +44,13 @@ class RolesComponent(pulumi.ComponentResource):
                                             f"{bucket_arn}/*"
                                         ],
                                     },
+                                ] + [
+                                    {
+                                        "Action": actions,
+                                        "Effect": "Allow",
+                                        "Resource": f"{bucket_arn}/{prefix}/*",
+                                    }
+                                    for prefix, actions in write_prefixes.items()
                                 ],
                             }
                         ),
@@ -46,6 +58,42 @@ class RolesComponent(pulumi.ComponentResource):
                 ),
             ]
 
+        if log_groups:
+            inline_policies.append(
+                aws.iam.RoleInlinePolicyArgs(
+                    name="logs",
+                    policy=json.dumps(
+                        {
+                            "Version": "2012-10-17",
+                            "Statement": [
+                                {
+                                    "Action": [
+                                        "logs:CreateLogGroup",
+                                        "logs:CreateLogStream",
+                                        "logs:PutLogEvents",
+                                        "logs:DescribeLogStreams",
+                                    ],
+                                    "Effect": "Allow",
+                                    "Resource": [
+                                        resource
+                                        for group in log_groups
+                                        for resource in (
+                                            f"arn:aws:logs:*:*:log-group:{group}",
+                                            f"arn:aws:logs:*:*:log-group:{group}:log-stream:*",
+                                        )
+                                    ],
+                                },
+                                {
+                                    "Action": ["logs:DescribeLogGroups"],
+                                    "Effect": "Allow",
+                                    "Resource": "*",
+                                },
+                            ],
+                        }
+                    ),
+                )
+            )
+
         self.base_instance_role = aws.iam.Role(
             "base-instance-role",
             assume_role_policy=json.dumps(
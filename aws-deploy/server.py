@@ -3,6 +3,7 @@ import pulumi_aws as aws
 from pulumi import Output, ResourceOptions
 from pulumi_aws.ec2 import subnet
 from pulumi_aws.iam import ssh_key
+from user_data import build, user_data_values
 
 class ServerComponent(pulumi.ComponentResource):
     def __init__(self, name: str,
@@ -20,11 +21,17 @@ class ServerComponent(pulumi.ComponentResource):
         proxy_http=None,
         proxy_https=None,
         no_proxy=None,
+        proxy_cache=None,
         user_data_file="./server_user_data.sh",
+        user_data_parts=None,
         stack_name=None,
         debug=False,
         region=None,
         ssh_access=False,
+        registry_mirror=None,
+        config_bucket=None,
+        build_cache=None,
+        telemetry=None,
         depends_on=[],
         opts=None):
         super().__init__("pkg:index:ServerComponent", name, None, opts)
@@ -41,13 +48,19 @@ class ServerComponent(pulumi.ComponentResource):
         self.instance_type = instance_type
         self.tags = tags
         self.user_data_file = user_data_file
+        self.user_data_parts = user_data_parts
         self.proxy_http = proxy_http
         self.proxy_https = proxy_https
         self.no_proxy = no_proxy
+        self.proxy_cache = proxy_cache
         self.stack_name = stack_name
         self.debug = debug
         self.region = region
         self.ssh_access = ssh_access
+        self.registry_mirror = registry_mirror
+        self.config_bucket = config_bucket
+        self.build_cache = build_cache
+        self.telemetry = telemetry
         self.depends_on = depends_on
 
         if self.ami_id is None:
@@ -74,7 +87,7 @@ class ServerComponent(pulumi.ComponentResource):
             "iam_instance_profile": instance_profile,
             "instance_type": self.instance_type, 
             "ami": self.ami.id,   
-            "user_data": self.get_user_data(),
+            "user_data_base64": self.get_user_data(),
             "root_block_device": aws.ec2.InstanceRootBlockDeviceArgs(
                 volume_type=self.root_volume_type,
                 volume_size=self.root_volume_size,
@@ -93,32 +106,68 @@ class ServerComponent(pulumi.ComponentResource):
 
         self.instance = aws.ec2.Instance(name, **kwargs)
 
+        if self.registry_mirror is not None and self.registry_mirror.get("volume-size") is not None:
+            # Stable resource name so the cache survives instance replacement
+            self.registry_mirror_volume = aws.ebs.Volume(
+                "registry-mirror-volume",
+                availability_zone=self.instance.availability_zone,
+                size=int(self.registry_mirror["volume-size"]),
+                type="gp3",
+                encrypted=True,
+                tags={"Name": f"registry-mirror-{name}"},
+                opts=ResourceOptions(parent=self),
+            )
+
+            # Detach from the old instance before attaching to its replacement. The old
+            # instance is stopped first, so the mounted filesystem is cleanly unmounted
+            # and the detach is not left busy while the registry is writing to it.
+            aws.ec2.VolumeAttachment(
+                "registry-mirror-attachment",
+                device_name="/dev/sdf",
+                volume_id=self.registry_mirror_volume.id,
+                instance_id=self.instance.id,
+                stop_instance_before_detaching=True,
+                opts=ResourceOptions(parent=self, delete_before_replace=True),
+            )
+
     def get_ami(self):
         return aws.ec2.get_ami(
             most_recent="true",
             owners=[137112412989],
                   filters=[{"name":"name","values":["amzn2-ami-hvm-*"]}])
 
+    def get_user_data_values(self):
+        return user_data_values(
+            proxy_http=self.proxy_http,
+            proxy_https=self.proxy_https,
+            no_proxy=self.no_proxy,
+            debug=self.debug,
+            region=self.region,
+            registry_mirror=self.registry_mirror,
+            proxy_cache=self.proxy_cache,
+            build_cache=self.build_cache,
+            telemetry=self.telemetry,
+        )
+
     def get_user_data(self):
+        values = self.get_user_data_values()
+        user_data = build(values, self.user_data_file, self.user_data_parts)
+
+        # Check the size now, using the longest possible role and bucket names, 64 and 63
+        # characters, as the real names are not known until the resources are created
+        user_data.render({
+            **values,
+            "instance_role": "x" * 64,
+            "config_bucket": "x" * 63,
+        })
 
         return Output.all(
-            self.proxy_http,
-            self.proxy_https,
-            self.no_proxy,
-            self.debug,
-            self.region,
-            Output.all(self.iam_role.name).apply(lambda l: f"{l[0]}")
+            self.iam_role.name,
+            self.config_bucket
         ).apply(
-            lambda args: (
-                open(self.user_data_file)
-                .read()
-                .format(
-                    proxy_http=args[0],
-                    proxy_https=args[1],
-                    no_proxy=args[2],
-                    debug=args[3],
-                    region=args[4],
-                    instance_role=args[5]
-                )
-            )
-        )
\ No newline at end of file
+            lambda args: user_data.render_base64({
+                **values,
+                "instance_role": args[0],
+                "config_bucket": args[1],
+            })
+        )
@@ -1,14 +1,14 @@
 #!/usr/bin/env bash
 
 debug_opt=""
-if [ "{debug}" == "True" ]; then
+if [ "{{debug}}" == "True" ]; then
     set -x
     debug_opt="--debug"
 fi
 
 export HOME=/home/ec2-user
 
-function SetAWSCreds () {{
+function SetAWSCreds () {
     INSTANCE_ROLE=$(aws sts get-caller-identity | jq -r '."Arn"' | cut -f 2 -d/)
     TOKEN=$(curl -s -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600")
     iam=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/iam/security-credentials/$INSTANCE_ROLE)
@@ -17,9 +17,9 @@ function SetAWSCreds () {{
     export AWS_SECRET_ACCESS_KEY=$(echo $iam | jq -r '."SecretAccessKey"')
     export AWS_SESSION_TOKEN=$(echo $iam | jq -r '."Token"')
     export AWS_REGION=$(curl --silent http://169.254.169.254/latest/dynamic/instance-identity/document | jq -r '."region"')
-}}
+}
 
-function GetParamValue() {{
+function GetParamValue() {
     local key="$1"
     if [ -z "$key" ]; then
         echo "ssm parameter key not provided"
@@ -27,47 +27,249 @@ function GetParamValue() {{
     fi
     local value="$(aws ssm get-parameter --name  $key --region $AWS_REGION --with-decryption | jq -r '."Parameter"["Value"]')"
     echo $value
-}}
+}
 
-Install () {{
+ProxyCachePeer () {
+    local name=$1
+    local peer=$(echo $2 | sed -e 's#^[a-zA-Z]*://##' -e 's#/.*$##')
+    local peer_host=$(echo $peer | cut -f1 -d:)
+    local peer_port=$(echo $peer | cut -s -f2 -d:)
+    if [ -z "$peer_port" ]; then
+        peer_port=3128
+    fi
+    echo "cache_peer $peer_host parent $peer_port 0 no-query no-digest name=$name"
+}
+
+SetupProxyCache () {
+    if [ "{{proxy_cache_port}}" == "None" ]; then
+        return
+    fi
+
+    local http_upstream="{{proxy_http}}"
+    local https_upstream="{{proxy_https}}"
+    if [ "$http_upstream" == "None" ]; then
+        http_upstream=$https_upstream
+    fi
+    if [ "$https_upstream" == "None" ]; then
+        https_upstream=$http_upstream
+    fi
+    if [ "$http_upstream" == "None" ]; then
+        echo "proxy cache requires an upstream proxy, skipping"
+        return
+    fi
+
+    echo "Installing proxy cache"
+    yum install -y squid
+
+    # https is tunnelled with CONNECT, send it to the https proxy when they differ
+    local peers="$(ProxyCachePeer http_upstream $http_upstream)"
+    if [ "$https_upstream" != "$http_upstream" ]; then
+        peers="$peers
+$(ProxyCachePeer https_upstream $https_upstream)
+cache_peer_access https_upstream allow CONNECT
+cache_peer_access https_upstream deny all
+cache_peer_access http_upstream deny CONNECT"
+    fi
+
+    cat > /etc/squid/squid.conf <<EOF
+http_port 127.0.0.1:{{proxy_cache_port}}
+
+acl CONNECT method CONNECT
+
+# Chain to the upstream proxy, the security group only allows egress to it
+$peers
+never_direct allow all
+
+http_access allow localhost manager
+http_access deny manager
+http_access allow localhost
+http_access deny all
+
+cache_mem 256 MB
+maximum_object_size 2 GB
+cache_dir ufs /var/spool/squid {{proxy_cache_size_mb}} 16 256
+coredump_dir /var/spool/squid
+
+# Repository metadata changes, packages and release artifacts do not
+refresh_pattern -i (repomd\.xml|metalink|mirrorlist|/latest/) 0 0% 0
+refresh_pattern -i \.(rpm|drpm|zip|tar\.gz|tgz|tar\.xz)$ 10080 100% 43200 refresh-ims
+refresh_pattern . 0 20% 4320
+EOF
+    systemctl enable squid
+    systemctl start squid
+
+    cat > /usr/local/bin/proxy-cache-stats <<EOF
+#!/bin/bash
+# Report request and byte hit rates of the local proxy cache
+squidclient -h 127.0.0.1 -p {{proxy_cache_port}} mgr:info | grep -E "Number of HTTP requests|Hits as|Memory hits|Disk hits|Storage Swap size"
+EOF
+    chmod 755 /usr/local/bin/proxy-cache-stats
+
+    # Point later downloads, shells and ci runs at the local cache
+    # Lines are rewritten by name, the proxy urls are not regular expressions and one
+    # can be a prefix of the other
+    local local_proxy="http://127.0.0.1:{{proxy_cache_port}}"
+    sed -i -e "s#^export \(HTTP_PROXY\|http_proxy\|HTTPS_PROXY\|https_proxy\)=.*#export \1=$local_proxy#" \
+        -e "s#^export curl_proxy_opt=.*#export curl_proxy_opt=\"--proxy $local_proxy\"#" /etc/ec2-dev/env.sh
+    sed -i -e "s#^proxy=.*#proxy=$local_proxy#" /etc/yum.conf
+    source /etc/ec2-dev/env.sh
+}
+
+ConfigureRegistryMirror () {
+    if [ "{{registry_mirror_remote}}" == "None" ]; then
+        return
+    fi
+
+    echo "Configuring registry mirror"
+    mkdir -p /etc/docker
+    cat > /etc/docker/daemon.json <<EOF
+{
+    "registry-mirrors": ["http://127.0.0.1:{{registry_mirror_port}}"]
+}
+EOF
+}
+
+StartRegistryMirror () {
+    if [ "{{registry_mirror_remote}}" == "None" ]; then
+        return
+    fi
+
+    echo "Starting registry mirror"
+    local mirror_dir=/var/lib/registry-mirror
+    mkdir -p $mirror_dir
+
+    if [ "{{registry_mirror_volume}}" == "True" ]; then
+        # The volume is attached after the instance starts, wait for it to appear
+        for i in $(seq 1 60); do
+            if [ -b /dev/sdf ]; then
+                break
+            fi
+            sleep 5
+        done
+        if [ -b /dev/sdf ]; then
+            if ! blkid /dev/sdf >/dev/null; then
+                mkfs -t xfs /dev/sdf
+            fi
+            echo "/dev/sdf $mirror_dir xfs defaults,nofail 0 2" >> /etc/fstab
+            mount $mirror_dir
+        else
+            echo "registry mirror volume not attached, using root volume"
+        fi
+    fi
+
+    local proxy_opts=""
+    if [ -n "$http_proxy" ]; then
+        proxy_opts="$proxy_opts -e HTTP_PROXY=$http_proxy"
+    fi
+    if [ -n "$https_proxy" ]; then
+        proxy_opts="$proxy_opts -e HTTPS_PROXY=$https_proxy"
+    fi
+    if [ -n "$no_proxy" ]; then
+        proxy_opts="$proxy_opts -e NO_PROXY=$no_proxy"
+    fi
+
+    # Host networking so a proxy on 127.0.0.1 is reachable from the mirror
+    docker run -d --restart=always --name registry-mirror --network host \
+        -e REGISTRY_HTTP_ADDR=127.0.0.1:{{registry_mirror_port}} \
+        -v $mirror_dir:/var/lib/registry \
+        -e REGISTRY_PROXY_REMOTEURL={{registry_mirror_remote}} \
+        $proxy_opts registry:2
+}
+
+SetupBuildCache () {
+    if [ "{{build_cache_max_mb}}" == "None" ]; then
+        return
+    fi
+
+    echo "Setting up build cache"
+    aws s3 cp s3://{{config_bucket}}/cache-sync.sh /usr/local/bin/cache-sync.sh
+    chmod 755 /usr/local/bin/cache-sync.sh
+    echo "export CACHE_MAX_MB={{build_cache_max_mb}}" >> /etc/ec2-dev/env.sh
+    echo "export CACHE_MAX_SHARD_MB={{build_cache_max_shard_mb}}" >> /etc/ec2-dev/env.sh
+
+    mkdir -p /usr/local/lib/docker/cli-plugins
+    curl $curl_proxy_opt -sL "https://github.com/docker/buildx/releases/download/v0.11.2/buildx-v0.11.2.linux-amd64" -o /usr/local/lib/docker/cli-plugins/docker-buildx
+    chmod 755 /usr/local/lib/docker/cli-plugins/docker-buildx
+    # Host networking lets BuildKit use the instance role for the S3 cache
+    sudo -u ec2-user -H docker buildx create --name ec2-dev --driver docker-container --driver-opt network=host --use
+
+    # The unit file is written from the user data by cloud-init
+    systemctl daemon-reload
+    systemctl enable ec2-dev-cache-restore.service
+    systemctl start ec2-dev-cache-restore.service
+}
+
+SetupTelemetry () {
+    if [ "{{telemetry_interval}}" == "None" ]; then
+        return
+    fi
+
+    echo "Setting up telemetry"
+    yum install -y python3 amazon-cloudwatch-agent
+    aws s3 cp s3://{{config_bucket}}/telemetry-agent.py /usr/local/bin/ec2-dev-telemetry
+    chmod 755 /usr/local/bin/ec2-dev-telemetry
+    mkdir -p /var/log/ec2-dev-telemetry /var/lib/ec2-dev-telemetry
+    # ci-runner.sh records spans as ec2-user
+    chown ec2-user /var/lib/ec2-dev-telemetry
+
+    # Let the CloudWatch agent accept EMF records on tcp 25888
+    cat > /opt/aws/amazon-cloudwatch-agent/etc/ec2-dev.json <<EOF
+{
+    "logs": {
+        "metrics_collected": {
+            "emf": {}
+        }
+    }
+}
+EOF
+    /opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl -a fetch-config -m ec2 -s -c file:/opt/aws/amazon-cloudwatch-agent/etc/ec2-dev.json
+
+    # The unit file is written from the user data by cloud-init
+    systemctl daemon-reload
+    systemctl enable ec2-dev-telemetry.service
+    systemctl start ec2-dev-telemetry.service
+}
+
+Install () {
     amazon-linux-extras install epel -y
 
     echo "Installing proxy"
 
-    echo "{proxy_http}"
-    echo "{proxy_https}"
-    echo "{no_proxy}"
+    echo "{{proxy_http}}"
+    echo "{{proxy_https}}"
+    echo "{{no_proxy}}"
 
     mkdir -p /etc/ec2-dev
 
-    if [ "{proxy_http}" != "None" ]; then
-        export http_proxy="{proxy_http}"
-        export HTTP_PROXY="{proxy_http}"
-        echo "export HTTP_PROXY={proxy_http}" >> /etc/ec2-dev/env.sh
-        echo "export http_proxy={proxy_http}" >> /etc/ec2-dev/env.sh
-        echo "proxy={proxy_http}" >> /etc/yum.conf
+    if [ "{{proxy_http}}" != "None" ]; then
+        export http_proxy="{{proxy_http}}"
+        export HTTP_PROXY="{{proxy_http}}"
+        echo "export HTTP_PROXY={{proxy_http}}" >> /etc/ec2-dev/env.sh
+        echo "export http_proxy={{proxy_http}}" >> /etc/ec2-dev/env.sh
+        echo "proxy={{proxy_http}}" >> /etc/yum.conf
     fi
 
-    if [ "{proxy_https}" != "None" ]; then
-        export https_proxy="{proxy_https}"
-        export HTTPS_PROXY="{proxy_https}"
-        echo "export HTTPS_PROXY={proxy_https}" >> /etc/ec2-dev/env.sh
-        echo "export https_proxy={proxy_https}" >> /etc/ec2-dev/env.sh
+    if [ "{{proxy_https}}" != "None" ]; then
+        export https_proxy="{{proxy_https}}"
+        export HTTPS_PROXY="{{proxy_https}}"
+        echo "export HTTPS_PROXY={{proxy_https}}" >> /etc/ec2-dev/env.sh
+        echo "export https_proxy={{proxy_https}}" >> /etc/ec2-dev/env.sh
         export curl_proxy_opt="--proxy $https_proxy"
         echo "export curl_proxy_opt=\"--proxy $https_proxy\"" >> /etc/ec2-dev/env.sh
     fi
 
-    if [ "{no_proxy}" != "None" ]; then
-        export no_proxy="{no_proxy}"
-        export NO_PROXY="{no_proxy}"
-        echo "export NO_PROXY={no_proxy}" >> /etc/ec2-dev/env.sh
-        echo "export no_proxy={no_proxy}" >> /etc/ec2-dev/env.sh
+    if [ "{{no_proxy}}" != "None" ]; then
+        export no_proxy="{{no_proxy}}"
+        export NO_PROXY="{{no_proxy}}"
+        echo "export NO_PROXY={{no_proxy}}" >> /etc/ec2-dev/env.sh
+        echo "export no_proxy={{no_proxy}}" >> /etc/ec2-dev/env.sh
     fi
 
     echo "Updating system packages & installing required utilities"
     yum-config-manager --enable epel
     yum update -y
     yum install -y jq curl unzip git git-lfs
+    SetupProxyCache
     curl $curl_proxy_opt "https://s3.amazonaws.com/session-manager-downloads/plugin/latest/linux_64bit/session-manager-plugin.rpm" -o "session-manager-plugin.rpm"
     sudo yum install -y session-manager-plugin.rpm
 
@@ -79,7 +281,7 @@ Install () {{
     unzip -q awscliv2.zip >/dev/null
     ./aws/install >/dev/null
 
-    export AWS_REGION={region}
+    export AWS_REGION={{region}}
     SetAWSCreds
 
     echo "Installing SSM Agent"
@@ -98,17 +300,22 @@ Install () {{
     sudo yum install -y docker
     sudo usermod -a -G docker ec2-user
     id ec2-user
+    ConfigureRegistryMirror
     sudo systemctl enable docker.service
     sudo systemctl start docker.service
+    StartRegistryMirror
     curl --silent --location "https://github.com/weaveworks/eksctl/releases/latest/download/eksctl_$(uname -s)_amd64.tar.gz" | tar xz -C /tmp
     sudo mv /tmp/eksctl /usr/local/bin
     curl -s https://fluxcd.io/install.sh | sudo bash
 
     
-}}
+}
 
 Install
 
-echo "export INSTANCE_ROLE={instance_role}" >> /etc/ec2-dev/env.sh
-echo "export AWS_REGION={region}" >> /etc/ec2-dev/env.sh
+echo "export INSTANCE_ROLE={{instance_role}}" >> /etc/ec2-dev/env.sh
+echo "export AWS_REGION={{region}}" >> /etc/ec2-dev/env.sh
+echo "export CONFIG_BUCKET={{config_bucket}}" >> /etc/ec2-dev/env.sh
 
+SetupBuildCache
+SetupTelemetry
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""Lightweight performance telemetry for ec2-dev instances.
+
+  telemetry-agent.py run [options]
+      Sample host and docker container metrics every interval and export them as
+      CloudWatch Embedded Metric Format, on a Prometheus endpoint and to a local file.
+
+  telemetry-agent.py span --name ci --pr 12 --commit abc123 --result 0 --start <epoch seconds>
+      Record a job span, e.g. a ci run, which the running agent exports with the next sample.
+
+Only files under /proc and /sys are read, so sampling costs a few milliseconds.
+"""
+import argparse
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SPOOL_FILE = "/var/lib/ec2-dev-telemetry/spans.jsonl"
+
+CPU_FIELDS = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+UNITS = {
+    "percent": "Percent",
+    "bytes": "Bytes",
+    "bytes_per_second": "Bytes/Second",
+    "per_second": "Count/Second",
+    "seconds": "Seconds",
+}
+
+
+def unit(name):
+    for suffix, cloudwatch_unit in UNITS.items():
+        if name.endswith(suffix):
+            return cloudwatch_unit
+    return "None"
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def instance_id():
+    try:
+        request = urllib.request.Request(
+            "http://169.254.169.254/latest/api/token",
+            method="PUT",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
+        )
+        token = urllib.request.urlopen(request, timeout=2).read().decode()
+        request = urllib.request.Request(
+            "http://169.254.169.254/latest/meta-data/instance-id",
+            headers={"X-aws-ec2-metadata-token": token},
+        )
+        return urllib.request.urlopen(request, timeout=2).read().decode()
+    except Exception:
+        return socket.gethostname()
+
+
+class Sampler:
+    """Turns cumulative counters from /proc and cgroups into rates between samples."""
+
+    def __init__(self, proc="/proc", cgroup="/sys/fs/cgroup"):
+        self.proc = proc
+        self.cgroup = cgroup
+        self.previous = {}
+        self.previous_time = None
+        self.containers_seen = {}
+
+    def sample(self):
+        now = time.time()
+        counters = {}
+        host = {}
+        self.cpu(counters)
+        self.disks(counters)
+        self.network(counters)
+        self.memory(host)
+        self.pressure(host)
+        containers, container_counters = self.containers()
+        counters.update(container_counters)
+
+        elapsed = now - self.previous_time if self.previous_time else None
+        disks = {}
+        interfaces = {}
+        deltas = {}
+        if elapsed:
+            for name, value in counters.items():
+                if name in self.previous:
+                    deltas[name] = max(value - self.previous[name], 0)
+        self.previous = counters
+        self.previous_time = now
+
+        if elapsed:
+            cpu_total = sum(deltas.get(f"cpu.{field}", 0) for field in CPU_FIELDS)
+            if cpu_total:
+                for field in ("user", "system", "iowait", "steal", "idle"):
+                    host[f"cpu_{field}_percent"] = 100.0 * deltas.get(f"cpu.{field}", 0) / cpu_total
+            for name, delta in deltas.items():
+                kind, _, rest = name.partition(".")
+                if kind == "disk":
+                    device, _, metric = rest.rpartition(".")
+                    disks.setdefault(device, {"device": device})[f"disk_{metric}"] = delta / elapsed
+                elif kind == "net":
+                    interface, _, metric = rest.rpartition(".")
+                    interfaces.setdefault(interface, {"interface": interface})[f"net_{metric}"] = delta / elapsed
+            for container in containers.values():
+                if f"container.{container['id']}.cpu_ns" in deltas:
+                    container["cpu_percent"] = deltas[f"container.{container['id']}.cpu_ns"] / 1e7 / elapsed
+
+        finished = []
+        for container_id, first_seen in list(self.containers_seen.items()):
+            if container_id not in containers:
+                finished.append({"name": "container", "container": container_id, "start": first_seen, "end": now, "duration_seconds": now - first_seen})
+                del self.containers_seen[container_id]
+        for container_id in containers:
+            self.containers_seen.setdefault(container_id, now)
+
+        return now, host, list(disks.values()), list(interfaces.values()), [c for c in containers.values() if "cpu_percent" in c], finished
+
+    def cpu(self, counters):
+        text = read(f"{self.proc}/stat") or ""
+        for line in text.splitlines():
+            if line.startswith("cpu "):
+                for field, value in zip(CPU_FIELDS, line.split()[1:]):
+                    counters[f"cpu.{field}"] = int(value)
+
+    def disks(self, counters):
+        text = read(f"{self.proc}/diskstats") or ""
+        for line in text.splitlines():
+            fields = line.split()
+            name = fields[2]
+            # Whole EBS and instance store disks, not partitions
+            if not (name.startswith("nvme") and "p" not in name[4:] or name.startswith("xvd") and not name[-1].isdigit()):
+                continue
+            counters[f"disk.{name}.read_per_second"] = int(fields[3])
+            counters[f"disk.{name}.write_per_second"] = int(fields[7])
+            counters[f"disk.{name}.read_bytes_per_second"] = int(fields[5]) * 512
+            counters[f"disk.{name}.write_bytes_per_second"] = int(fields[9]) * 512
+            # Milliseconds spent doing IO per second, / 10 gives percent busy
+            counters[f"disk.{name}.busy_percent"] = int(fields[12]) / 10.0
+
+    def network(self, counters):
+        text = read(f"{self.proc}/net/dev") or ""
+        for line in text.splitlines()[2:]:
+            name, _, data = line.partition(":")
+            name = name.strip()
+            # Loopback and docker bridges, container traffic is also counted on the host interface
+            if name == "lo" or name.startswith(("veth", "docker", "br-")):
+                continue
+            fields = data.split()
+            counters[f"net.{name}.receive_bytes_per_second"] = int(fields[0])
+            counters[f"net.{name}.transmit_bytes_per_second"] = int(fields[8])
+
+    def memory(self, host):
+        text = read(f"{self.proc}/meminfo") or ""
+        info = {}
+        for line in text.splitlines():
+            name, _, value = line.partition(":")
+            info[name] = int(value.split()[0]) * 1024
+        if "MemTotal" in info:
+            available = info.get("MemAvailable", info.get("MemFree", 0))
+            host["memory_available_bytes"] = available
+            host["memory_used_percent"] = 100.0 * (info["MemTotal"] - available) / info["MemTotal"]
+            host["swap_used_bytes"] = info.get("SwapTotal", 0) - info.get("SwapFree", 0)
+
+    def pressure(self, host):
+        # Pressure stall information needs kernel 4.20 or later, e.g. the 5.10 kernel
+        for resource in ("cpu", "memory", "io"):
+            text = read(f"{self.proc}/pressure/{resource}")
+            if not text:
+                continue
+            for line in text.splitlines():
+                kind, *fields = line.split()
+                values = dict(field.split("=") for field in fields)
+                host[f"pressure_{resource}_{kind}_avg10_percent"] = float(values["avg10"])
+
+    def containers(self):
+        containers = {}
+        counters = {}
+        # cgroup v1 layout, as used by docker on Amazon Linux 2
+        for path in glob.glob(f"{self.cgroup}/cpu,cpuacct/docker/*/cpuacct.usage"):
+            container_id = path.split("/")[-2][:12]
+            counters[f"container.{container_id}.cpu_ns"] = int(read(path) or 0)
+            memory = read(f"{self.cgroup}/memory/docker/{path.split('/')[-2]}/memory.usage_in_bytes")
+            containers[container_id] = {"id": container_id, "memory_bytes": int(memory or 0)}
+        # cgroup v2 layout with the systemd cgroup driver
+        for path in glob.glob(f"{self.cgroup}/system.slice/docker-*.scope/cpu.stat"):
+            scope = path.split("/")[-2]
+            container_id = scope[len("docker-"):][:12]
+            stat = dict(line.split() for line in (read(path) or "").splitlines())
+            counters[f"container.{container_id}.cpu_ns"] = int(stat.get("usage_usec", 0)) * 1000
+            memory = read(f"{self.cgroup}/system.slice/{scope}/memory.current")
+            containers[container_id] = {"id": container_id, "memory_bytes": int(memory or 0)}
+        return containers, counters
+
+
+def emf_record(namespace, timestamp, dimensions, metrics, properties):
+    record = {
+        "_aws": {
+            "Timestamp": int(timestamp * 1000),
+            "LogGroupName": "ec2-dev-telemetry",
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit(name)} for name in metrics],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(properties)
+    record.update(metrics)
+    return record
+
+
+def emf_records(namespace, instance, timestamp, host, disks, interfaces, containers, spans):
+    records = [emf_record(namespace, timestamp, {"InstanceId": instance}, host, {})]
+    for disk in disks:
+        records.append(emf_record(
+            namespace, timestamp, {"InstanceId": instance, "Device": disk["device"]},
+            {name: value for name, value in disk.items() if name != "device"}, {},
+        ))
+    for interface in interfaces:
+        records.append(emf_record(
+            namespace, timestamp, {"InstanceId": instance, "Interface": interface["interface"]},
+            {name: value for name, value in interface.items() if name != "interface"}, {},
+        ))
+    for container in containers:
+        records.append(emf_record(
+            namespace, timestamp, {"InstanceId": instance, "Container": container["id"]},
+            {"container_cpu_percent": container["cpu_percent"], "container_memory_bytes": container["memory_bytes"]}, {},
+        ))
+    for span in spans:
+        # PR and commit are properties, not dimensions, to keep metric cardinality low
+        properties = {key: value for key, value in span.items() if key not in ("name", "duration_seconds")}
+        records.append(emf_record(
+            namespace, span.get("end", timestamp), {"InstanceId": instance, "Job": span["name"]},
+            {"job_duration_seconds": span["duration_seconds"]}, properties,
+        ))
+    return records
+
+
+class EmfSink:
+    def __init__(self, namespace, path=None, endpoint=None):
+        self.namespace = namespace
+        self.path = path
+        self.endpoint = endpoint
+        self.socket = None
+
+    def write(self, records):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(lines)
+        if self.endpoint:
+            try:
+                if self.socket is None:
+                    host, port = self.endpoint.replace("tcp://", "").rsplit(":", 1)
+                    self.socket = socket.create_connection((host, int(port)), timeout=2)
+                self.socket.sendall(lines.encode())
+            except OSError:
+                # The CloudWatch agent may not be running yet, reconnect next time
+                self.socket = None
+
+
+class PrometheusSink:
+    def __init__(self, port):
+        self.text = ""
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.text.encode()
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def update(self, host, disks, interfaces, containers, spans):
+        lines = []
+        for name, value in sorted(host.items()):
+            lines.append(f"# TYPE ec2_dev_{name} gauge")
+            lines.append(f"ec2_dev_{name} {value}")
+        for label, devices in (("device", disks), ("interface", interfaces)):
+            for name in sorted({name for device in devices for name in device if name != label}):
+                lines.append(f"# TYPE ec2_dev_{name} gauge")
+                for device in devices:
+                    if name in device:
+                        lines.append(f'ec2_dev_{name}{{{label}="{device[label]}"}} {device[name]}')
+        for name in ("cpu_percent", "memory_bytes"):
+            lines.append(f"# TYPE ec2_dev_container_{name} gauge")
+            for container in containers:
+                lines.append(f'ec2_dev_container_{name}{{container="{container["id"]}"}} {container[name]}')
+        lines.append("# TYPE ec2_dev_job_duration_seconds gauge")
+        for span in spans:
+            labels = ",".join(f'{key}="{span[key]}"' for key in ("name", "pr", "commit", "result", "container") if key in span)
+            lines.append(f"ec2_dev_job_duration_seconds{{{labels}}} {span['duration_seconds']}")
+        self.text = "\n".join(lines) + "\n"
+
+
+def read_spans(offset):
+    """Spans recorded since offset, and the offset to read from next time."""
+    spans = []
+    try:
+        with open(SPOOL_FILE) as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                # Nothing more, or a span still being written
+                if not line.endswith("\n"):
+                    break
+                offset = f.tell()
+                try:
+                    if line.strip():
+                        spans.append(json.loads(line))
+                except ValueError:
+                    # e.g. a span write cut short, later spans are still exported
+                    print(f"skipping malformed span: {line.strip()}", file=sys.stderr)
+    except FileNotFoundError:
+        pass
+    return spans, offset
+
+
+def run(args):
+    instance = args.instance_id or instance_id()
+    sampler = Sampler(args.proc, args.cgroup)
+    emf = EmfSink(args.namespace, args.emf_file, args.emf_endpoint)
+    prometheus = PrometheusSink(args.prometheus_port) if args.prometheus_port else None
+    recent_spans = []
+    spool_offset = os.path.getsize(SPOOL_FILE) if os.path.exists(SPOOL_FILE) else 0
+
+    while True:
+        timestamp, host, disks, interfaces, containers, finished = sampler.sample()
+        spans, spool_offset = read_spans(spool_offset)
+        spans += finished
+
+        if host:
+            emf.write(emf_records(args.namespace, instance, timestamp, host, disks, interfaces, containers, spans))
+
+            if args.file:
+                with open(args.file, "a") as f:
+                    f.write(json.dumps({"timestamp": timestamp, "instance_id": instance, "host": host, "disks": disks, "interfaces": interfaces, "containers": containers, "spans": spans}) + "\n")
+
+            if prometheus:
+                recent_spans = (recent_spans + spans)[-20:]
+                prometheus.update(host, disks, interfaces, containers, recent_spans)
+
+        time.sleep(args.interval)
+
+
+def span(args):
+    end = args.end or time.time()
+    record = {
+        "name": args.name,
+        "start": args.start,
+        "end": end,
+        "duration_seconds": end - args.start,
+    }
+    for key in ("pr", "commit", "result"):
+        value = getattr(args, key)
+        if value is not None:
+            record[key] = value
+    os.makedirs(os.path.dirname(SPOOL_FILE), exist_ok=True)
+    with open(SPOOL_FILE, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def main():
+    global SPOOL_FILE
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--spool-file", default=SPOOL_FILE, help="file spans are recorded in")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="sample and export metrics")
+    run_parser.add_argument("--interval", type=float, default=15, help="seconds between samples")
+    run_parser.add_argument("--namespace", default="ec2-dev", help="CloudWatch metric namespace")
+    run_parser.add_argument("--emf-endpoint", help="send EMF records to the CloudWatch agent, e.g. tcp://127.0.0.1:25888")
+    run_parser.add_argument("--emf-file", help="append EMF records to this file")
+    run_parser.add_argument("--prometheus-port", type=int, help="serve Prometheus metrics on 127.0.0.1:<port>/metrics")
+    run_parser.add_argument("--file", help="append samples as json lines to this file, e.g. for offline analysis")
+    run_parser.add_argument("--instance-id", help="defaults to the id from instance metadata")
+    run_parser.add_argument("--proc", default="/proc")
+    run_parser.add_argument("--cgroup", default="/sys/fs/cgroup")
+
+    span_parser = commands.add_parser("span", help="record a job span")
+    span_parser.add_argument("--name", required=True)
+    span_parser.add_argument("--start", type=float, required=True, help="start time in epoch seconds")
+    span_parser.add_argument("--end", type=float, help="end time in epoch seconds, defaults to now")
+    span_parser.add_argument("--pr")
+    span_parser.add_argument("--commit")
+    span_parser.add_argument("--result")
+
+    args = parser.parse_args()
+    SPOOL_FILE = args.spool_file
+    if args.command == "run":
+        run(args)
+    else:
+        span(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import base64
+import gzip
+import json
+import os
+import re
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Iterable, Mapping, Optional
+
+# EC2 rejects user data larger than this, measured before base64 encoding
+USER_DATA_LIMIT = 16384
+
+# Fixed so the rendered user data, and hence the instance, only changes when the content does
+MIME_BOUNDARY = "==ec2-dev-user-data=="
+
+PER_BOOT_DIR = "/var/lib/cloud/scripts/per-boot"
+
+# Unit files and other parts shipped alongside this module
+DEPLOY_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Values only known once the role and bucket resources are created
+RESOURCE_VARIABLES = ("instance_role", "config_bucket")
+
+# Other {{ text, e.g. docker --format '{{.Names}}', is used as is. \{{ escapes a
+# literal {{ that would otherwise be a placeholder, e.g. a go template's {{end}}.
+PLACEHOLDER = re.compile(r"(?<!\\)\{\{\s*(\w+)\s*\}\}")
+ESCAPE = "\\{{"
+
+# Left over from the previous str.format syntax, where {name} was a placeholder and {{ a
+# literal brace. ${name} is a shell expansion, not a placeholder.
+OLD_PLACEHOLDER = re.compile(r"(?<![{$])\{(\w+)\}(?!\})")
+
+
+class UserDataTemplate:
+    """A text file with {{name}} placeholders, read and checked once when loaded."""
+    path: str
+    names: frozenset
+
+    def __init__(self, path: str, variables: Iterable[str]):
+        self.path = path
+        with open(path) as f:
+            text = f.read()
+
+        # Alternating literal text and placeholder names
+        self.chunks = PLACEHOLDER.split(text)
+        self.names = frozenset(self.chunks[1::2])
+
+        unknown = self.names - set(variables)
+        if unknown:
+            raise Exception(f"{path}: unknown template variables {', '.join(sorted(unknown))}, "
+                            f"write \\{{{{ for a literal {{{{")
+
+        literal = "".join(self.chunks[0::2])
+        old = {name for name in OLD_PLACEHOLDER.findall(literal) if name in variables}
+        if old:
+            placeholders = ", ".join(f"{{{{{name}}}}} instead of {{{name}}}" for name in sorted(old))
+            raise Exception(f"{path}: placeholders are now written {placeholders}")
+        self.chunks[0::2] = [chunk.replace(ESCAPE, "{{") for chunk in self.chunks[0::2]]
+
+    def render(self, values: Mapping[str, object]) -> str:
+        missing = self.names - set(values)
+        if missing:
+            raise Exception(f"{self.path}: no value for template variables {', '.join(sorted(missing))}")
+        return "".join(
+            chunk if i % 2 == 0 else str(values[chunk])
+            for i, chunk in enumerate(self.chunks)
+        )
+
+
+class UserData:
+    """Builds gzip compressed cloud-init multipart user data from templates.
+
+    Scripts run once per instance unless per_boot is set, in which case they are
+    installed in cloud-init's per-boot directory and run on every boot.
+    Files are written with cloud-init's write_files before any script runs.
+    """
+    variables: frozenset
+    limit: int
+
+    def __init__(self, variables: Iterable[str], limit: Optional[int] = USER_DATA_LIMIT):
+        self.variables = frozenset(variables)
+        self.limit = limit
+        self.scripts = []
+        self.files = []
+
+    def add_script(self, path: str, per_boot: Optional[bool] = False):
+        template = UserDataTemplate(path, self.variables)
+        if per_boot:
+            name = path.rsplit("/", 1)[-1]
+            self.add_file(f"{PER_BOOT_DIR}/{name}", path, permissions="0755")
+        else:
+            self.scripts.append(template)
+
+    def add_file(self, dest: str, path: str, permissions: Optional[str] = "0644", owner: Optional[str] = "root:root"):
+        template = UserDataTemplate(path, self.variables)
+        self.files.append((dest, template, permissions, owner))
+
+    def render_mime(self, values: Mapping[str, object]) -> bytes:
+        message = MIMEMultipart(boundary=MIME_BOUNDARY)
+
+        if self.files:
+            write_files = [
+                {
+                    "path": dest,
+                    "content": base64.b64encode(template.render(values).encode()).decode(),
+                    "encoding": "b64",
+                    "permissions": permissions,
+                    "owner": owner,
+                }
+                for dest, template, permissions, owner in self.files
+            ]
+            # JSON is valid YAML, so no YAML library is needed
+            cloud_config = "#cloud-config\n" + json.dumps({"write_files": write_files}, indent=1)
+            message.attach(MIMEText(cloud_config, "cloud-config"))
+
+        for template in self.scripts:
+            message.attach(MIMEText(template.render(values), "x-shellscript"))
+
+        return message.as_bytes()
+
+    def render(self, values: Mapping[str, object]) -> bytes:
+        data = gzip.compress(self.render_mime(values), mtime=0)
+        if self.limit is not None and len(data) > self.limit:
+            raise Exception(f"user data is {len(data)} bytes compressed, exceeding the EC2 limit of {self.limit} bytes")
+        return data
+
+    def render_base64(self, values: Mapping[str, object]) -> str:
+        return base64.b64encode(self.render(values)).decode()
+
+
+def user_data_values(proxy_http=None, proxy_https=None, no_proxy=None, debug=False, region=None,
+                     registry_mirror=None, proxy_cache=None, build_cache=None, telemetry=None) -> dict:
+    """Template values for the server configuration, None disables an optional feature."""
+    registry_mirror_remote = None
+    registry_mirror_port = 5000
+    registry_mirror_volume = False
+    if registry_mirror is not None:
+        registry_mirror_remote = registry_mirror.get("remote-url", "https://registry-1.docker.io")
+        registry_mirror_port = registry_mirror.get("port", 5000)
+        registry_mirror_volume = registry_mirror.get("volume-size") is not None
+
+    proxy_cache_port = None
+    proxy_cache_size_mb = 10240
+    if proxy_cache is not None:
+        proxy_cache_port = proxy_cache.get("port", 3128)
+        proxy_cache_size_mb = proxy_cache.get("cache-size-mb", 10240)
+
+    build_cache_max_mb = None
+    build_cache_max_shard_mb = 1024
+    if build_cache is not None:
+        build_cache_max_mb = build_cache.get("max-size-mb", 10240)
+        build_cache_max_shard_mb = build_cache.get("max-shard-mb", 1024)
+
+    telemetry_interval = None
+    telemetry_port = 9101
+    telemetry_namespace = "ec2-dev"
+    if telemetry is not None:
+        telemetry_interval = telemetry.get("interval", 15)
+        telemetry_port = telemetry.get("prometheus-port", 9101)
+        telemetry_namespace = telemetry.get("namespace", "ec2-dev")
+
+    return {
+        "proxy_http": proxy_http,
+        "proxy_https": proxy_https,
+        "no_proxy": no_proxy,
+        "debug": debug,
+        "region": region,
+        "registry_mirror_remote": registry_mirror_remote,
+        "registry_mirror_port": registry_mirror_port,
+        "registry_mirror_volume": registry_mirror_volume,
+        "build_cache_max_mb": build_cache_max_mb,
+        "build_cache_max_shard_mb": build_cache_max_shard_mb,
+        "proxy_cache_port": proxy_cache_port,
+        "proxy_cache_size_mb": proxy_cache_size_mb,
+        "telemetry_interval": telemetry_interval,
+        "telemetry_port": telemetry_port,
+        "telemetry_namespace": telemetry_namespace,
+    }
+
+
+def build(values: Mapping[str, object], user_data_file: str, user_data_parts: Optional[Iterable[Mapping]] = None) -> UserData:
+    """The user data parts for the values from user_data_values, as deployed by ServerComponent."""
+    user_data = UserData(set(values) | set(RESOURCE_VARIABLES))
+    user_data.add_script(user_data_file)
+
+    if values["build_cache_max_mb"] is not None:
+        user_data.add_file("/etc/systemd/system/ec2-dev-cache-restore.service", os.path.join(DEPLOY_DIR, "ec2-dev-cache-restore.service"))
+
+    if values["telemetry_interval"] is not None:
+        user_data.add_file("/etc/systemd/system/ec2-dev-telemetry.service", os.path.join(DEPLOY_DIR, "ec2-dev-telemetry.service"))
+        user_data.add_file("/etc/logrotate.d/ec2-dev-telemetry", os.path.join(DEPLOY_DIR, "ec2-dev-telemetry.logrotate"))
+
+    for part in user_data_parts or []:
+        part_type = part.get("type", "per-instance")
+        if part_type == "file":
+            user_data.add_file(part["path"], part["file"], permissions=part.get("permissions", "0644"))
+        elif part_type in ("per-instance", "per-boot"):
+            user_data.add_script(part["file"], per_boot=part_type == "per-boot")
+        else:
+            raise Exception(f"unknown user data part type: {part_type}")
+
+    return user_data
@@ -0,0 +1,338 @@
+"""Run the instance bootstrap in a local Amazon Linux 2 container and time it.
+
+The user data is rendered with the same templates and renderer as ServerComponent,
+then its write_files and shell script parts are applied in a fresh container for
+each run, the way cloud-init would. Instance metadata, STS, SSM and S3 are served
+by fake_aws.py on 169.254.169.254 in a dedicated docker network, and downloads of
+known artifacts can be served from a local cache.
+
+Each line of bootstrap output is timestamped. A step starts at each line matching
+--step-pattern and lasts until the next one. Per step and total wall times are
+reported across runs.
+"""
+import argparse
+import base64
+import email
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEPLOY_DIR = os.path.join(os.path.dirname(HERE), "aws-deploy")
+sys.path.insert(0, DEPLOY_DIR)
+
+from user_data import build, user_data_values  # noqa: E402
+
+NETWORK = "ec2-dev-bench"
+SUBNET = "169.254.169.0/24"
+ENDPOINT = "169.254.169.254"
+IMAGE = "ec2-dev-bench"
+FAKE_IMAGE = "python:3.11-alpine"
+FAKE_CONTAINER = "ec2-dev-bench-aws"
+CONFIG_BUCKET = "ec2-dev-bench-config"
+ROLE = "ec2-dev-bench-role"
+
+# The values ServerComponent renders with no optional features
+DEFAULT_VALUES = {
+    **user_data_values(region="eu-west-1"),
+    "instance_role": ROLE,
+    "config_bucket": CONFIG_BUCKET,
+}
+
+# Downloads from these hosts are redirected to the artifact cache when --artifacts is used
+ARTIFACT_HOSTS = [
+    "awscli.amazonaws.com",
+    "s3.amazonaws.com",
+    "amazon-eks.s3-us-west-2.amazonaws.com",
+    "dl.k8s.io",
+    "github.com",
+    "fluxcd.io",
+]
+
+STEP_PATTERN = r"^(Installing|Updating|Downloading|Configuring|Starting|Setting up)\b"
+
+AWS_ENV = {
+    "AWS_ENDPOINT_URL_STS": f"http://{ENDPOINT}:8081",
+    "AWS_ENDPOINT_URL_SSM": f"http://{ENDPOINT}:8081",
+    "AWS_ENDPOINT_URL_S3": f"http://{ENDPOINT}:8082",
+    "AWS_CONFIG_FILE": "/etc/ec2-dev-bench/aws-config",
+    "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+    "AWS_RESPONSE_CHECKSUM_VALIDATION": "when_required",
+}
+
+AWS_CONFIG = """[default]
+s3 =
+    addressing_style = path
+"""
+
+
+def docker(*args, check=True, capture=False, input=None):
+    result = subprocess.run(
+        ["docker", *args],
+        check=check,
+        input=input,
+        stdout=subprocess.PIPE if capture else None,
+    )
+    return result.stdout.decode() if capture else result.returncode
+
+
+def parse_value(text):
+    if text == "None":
+        return None
+    if text in ("True", "False"):
+        return text == "True"
+    return text
+
+
+def render(args):
+    values = dict(DEFAULT_VALUES)
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        if name not in values:
+            raise Exception(f"unknown user data value: {name}")
+        values[name] = parse_value(value)
+
+    user_data = build(values, args.user_data_file)
+    size = len(user_data.render(values))
+
+    files = []
+    scripts = []
+    for part in email.message_from_bytes(user_data.render_mime(values)).walk():
+        if part.get_content_type() == "text/cloud-config":
+            config = json.loads(part.get_payload(decode=True).decode().split("\n", 1)[1])
+            files.extend(config["write_files"])
+        elif part.get_content_type() == "text/x-shellscript":
+            scripts.append(part.get_payload(decode=True).decode())
+
+    if args.artifacts:
+        hosts = "|".join(re.escape(host) for host in ARTIFACT_HOSTS)
+        scripts = [re.sub(rf"https://({hosts})/", rf"http://{ENDPOINT}:8080/\1/", script) for script in scripts]
+
+    return size, files, scripts
+
+
+def start_endpoints(args, data_dir):
+    if subprocess.run(["docker", "network", "inspect", NETWORK], capture_output=True).returncode != 0:
+        docker("network", "create", "--subnet", SUBNET, NETWORK)
+
+    bucket_dir = os.path.join(data_dir, "s3", CONFIG_BUCKET)
+    os.makedirs(bucket_dir, exist_ok=True)
+    shutil.copy(os.path.join(DEPLOY_DIR, "cache-sync.sh"), bucket_dir)
+    shutil.copy(os.path.join(DEPLOY_DIR, "telemetry-agent.py"), bucket_dir)
+    os.makedirs(os.path.join(data_dir, "git"), exist_ok=True)
+
+    fake_args = ["--region", DEFAULT_VALUES["region"]]
+    volumes = ["-v", f"{os.path.join(HERE, 'fake_aws.py')}:/fake_aws.py:ro", "-v", f"{data_dir}:/data"]
+    if args.artifacts:
+        volumes += ["-v", f"{os.path.abspath(args.artifacts)}:/data/artifacts"]
+        fake_args.append("--fetch")
+    if args.ssm_params:
+        volumes += ["-v", f"{os.path.abspath(args.ssm_params)}:/ssm-params.json:ro"]
+        fake_args += ["--ssm-params", "/ssm-params.json"]
+
+    docker("rm", "-f", FAKE_CONTAINER, check=False, capture=True)
+    docker("run", "-d", "--rm", "--name", FAKE_CONTAINER, "--network", NETWORK, "--ip", ENDPOINT,
+           *volumes, FAKE_IMAGE, "python", "/fake_aws.py", *fake_args, capture=True)
+    for _ in range(30):
+        if "ready" in docker("logs", FAKE_CONTAINER, check=False, capture=True):
+            return
+        time.sleep(1)
+    raise Exception("fake aws endpoints did not start")
+
+
+def publish_ci_repo(args, data_dir):
+    name = os.path.basename(os.path.abspath(args.ci_repo))
+    bare = os.path.join(data_dir, "git", "bench", f"{name}.git")
+    subprocess.run(["git", "clone", "-q", "--bare", args.ci_repo, bare], check=True)
+    subprocess.run(["git", "-C", bare, "update-server-info"], check=True)
+    sha = subprocess.run(["git", "-C", args.ci_repo, "rev-parse", "HEAD"], check=True, stdout=subprocess.PIPE).stdout.decode().strip()
+    return f"bench/{name}", sha
+
+
+def exec_timed(container, command, user="root", env=None, verbose=False):
+    """Run a command in the container, returning its exit code and timestamped output lines."""
+    env_args = []
+    for name, value in (env or {}).items():
+        env_args += ["-e", f"{name}={value}"]
+    process = subprocess.Popen(
+        ["docker", "exec", "-u", user, *env_args, container, "bash", "-c", command],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    lines = []
+    for line in process.stdout:
+        text = line.decode(errors="replace").rstrip()
+        lines.append((time.monotonic(), text))
+        if verbose:
+            print(f"    {text}")
+    return process.wait(), lines
+
+
+def split_steps(start, end, lines, pattern, first_step):
+    steps = []
+    name, began = first_step, start
+    for timestamp, text in lines:
+        if pattern.match(text):
+            steps.append((name, timestamp - began))
+            name, began = text, timestamp
+    steps.append((name, end - began))
+    return steps
+
+
+def write_file(container, path, content, permissions="0644", owner="root:root"):
+    directory = os.path.dirname(path)
+    docker("exec", "-i", container, "sh", "-c", f"mkdir -p {directory} && cat > {path} && chmod {permissions} {path} && chown {owner} {path}", input=content)
+
+
+def run_once(args, index, files, scripts, ci):
+    container = f"{IMAGE}-{index}"
+    pattern = re.compile(args.step_pattern)
+    docker("rm", "-f", container, check=False, capture=True)
+    docker("run", "-d", "--privileged", "--network", NETWORK, "--name", container, IMAGE, capture=True)
+    steps = []
+    failures = []
+    try:
+        write_file(container, AWS_ENV["AWS_CONFIG_FILE"], AWS_CONFIG.encode())
+        env_sh = "".join(f"export {name}={value}\n" for name, value in AWS_ENV.items())
+        write_file(container, "/etc/ec2-dev/env.sh", env_sh.encode())
+
+        start = time.monotonic()
+        for entry in files:
+            content = entry["content"].encode()
+            if entry.get("encoding") == "b64":
+                content = base64.b64decode(content)
+            write_file(container, entry["path"], content, entry.get("permissions", "0644"), entry.get("owner", "root:root"))
+
+        for number, script in enumerate(scripts):
+            path = f"/var/lib/cloud/instance/scripts/part-{number:03d}"
+            write_file(container, path, script.encode(), "0700")
+            part_start = time.monotonic()
+            code, lines = exec_timed(container, path, env=AWS_ENV, verbose=args.verbose)
+            steps += split_steps(part_start, time.monotonic(), lines, pattern, f"part-{number:03d}")
+            if code != 0:
+                failures.append(f"part-{number:03d} exited {code}")
+        bootstrap_end = time.monotonic()
+        steps.append(("bootstrap total", bootstrap_end - start))
+
+        if args.set_creds:
+            write_file(container, "/tmp/set-creds.sh", open(os.path.join(DEPLOY_DIR, "set-creds.sh"), "rb").read(), "0755")
+            step_start = time.monotonic()
+            code, _ = exec_timed(container, "source /etc/ec2-dev/env.sh && source /tmp/set-creds.sh && test -n \"$AWS_SESSION_TOKEN\"", user="ec2-user", verbose=args.verbose)
+            steps.append(("set-creds.sh", time.monotonic() - step_start))
+            if code != 0:
+                failures.append(f"set-creds.sh exited {code}")
+
+        if ci is not None:
+            repo, sha = ci
+            write_file(container, "/tmp/ci-runner.sh", open(os.path.join(DEPLOY_DIR, "ci-runner.sh"), "rb").read(), "0755")
+            ci_env = {
+                "GITHUB_URL": f"http://{ENDPOINT}:8080/git",
+                "GITHUB_API_URL": f"http://{ENDPOINT}:8080",
+                "GITHUB_ORG_REPO": repo,
+                "GITHUB_TOKEN": "bench",
+                "CI_SCRIPT": args.ci_script,
+                "CI_ID": "bench",
+                "INSTANCE_ROLE": ROLE,
+            }
+            exports = " ".join(f"{name}={value}" for name, value in ci_env.items())
+            step_start = time.monotonic()
+            code, _ = exec_timed(
+                container,
+                f"source /etc/ec2-dev/env.sh && {exports} /tmp/ci-runner.sh --pull-request 1 --commit-sha {sha} --url http://{ENDPOINT}:8080/bench/log",
+                user="ec2-user",
+                verbose=args.verbose,
+            )
+            steps.append(("ci-runner.sh", time.monotonic() - step_start))
+            if code != 0:
+                failures.append(f"ci-runner.sh exited {code}")
+
+        steps.append(("total", time.monotonic() - start))
+    finally:
+        if not args.keep:
+            docker("rm", "-f", container, check=False, capture=True)
+    return steps, failures
+
+
+def report(results, size):
+    order = []
+    durations = {}
+    for steps, _ in results:
+        for name, seconds in steps:
+            if name not in durations:
+                order.append(name)
+                durations[name] = []
+            durations[name].append(seconds)
+
+    width = max(len(name) for name in order)
+    print(f"\nuser data: {size} bytes compressed, runs: {len(results)}")
+    print(f"{'step':<{width}}  {'mean':>8}  {'min':>8}  {'max':>8}  {'runs':>4}")
+    for name in order:
+        values = durations[name]
+        print(f"{name:<{width}}  {statistics.mean(values):8.1f}  {min(values):8.1f}  {max(values):8.1f}  {len(values):>4}")
+    for run, (_, failures) in enumerate(results):
+        for failure in failures:
+            print(f"run {run}: {failure}")
+
+    return {
+        "user_data_bytes": size,
+        "runs": [dict(steps=[{"step": name, "seconds": seconds} for name, seconds in steps], failures=failures)
+                 for steps, failures in results],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=1, help="number of runs, each in a fresh container")
+    parser.add_argument("--user-data-file", default=os.path.join(DEPLOY_DIR, "server_user_data.sh"))
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a user data value, e.g. registry_mirror_remote=https://registry-1.docker.io")
+    parser.add_argument("--artifacts", metavar="DIR", help="serve downloads from, and cache them in, this directory")
+    parser.add_argument("--ssm-params", metavar="FILE", help="json file of ssm parameter names to values")
+    parser.add_argument("--set-creds", action="store_true", help="also time set-creds.sh")
+    parser.add_argument("--ci-repo", metavar="DIR", help="also time ci-runner.sh against this local git repository")
+    parser.add_argument("--ci-script", default="./ci.sh", help="ci script in the --ci-repo repository")
+    parser.add_argument("--step-pattern", default=STEP_PATTERN, help="regular expression for output lines that start a step")
+    parser.add_argument("--json", metavar="FILE", help="write results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the containers after each run")
+    parser.add_argument("--no-build", action="store_true", help="use the existing benchmark image")
+    parser.add_argument("--verbose", action="store_true", help="show bootstrap output")
+    args = parser.parse_args()
+
+    size, files, scripts = render(args)
+
+    if not args.no_build:
+        docker("build", "-q", "-t", IMAGE, HERE, capture=True)
+
+    data_dir = tempfile.mkdtemp(prefix="ec2-dev-bench-")
+    try:
+        start_endpoints(args, data_dir)
+        ci = publish_ci_repo(args, data_dir) if args.ci_repo else None
+
+        results = []
+        for index in range(args.runs):
+            print(f"run {index + 1} of {args.runs}", flush=True)
+            results.append(run_once(args, index, files, scripts, ci))
+
+        summary = report(results, size)
+        if args.artifacts:
+            summary["artifacts"] = json.loads(docker("exec", FAKE_CONTAINER, "wget", "-qO-", "http://127.0.0.1:8080/bench/counters", capture=True))
+            print(f"artifact cache: {summary['artifacts']}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summary, f, indent=2)
+    finally:
+        docker("rm", "-f", FAKE_CONTAINER, check=False, capture=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if any(failures for _, failures in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Stand-ins for the endpoints the instance bootstrap talks to.
+
+Serves, on the configured address:
+  port 80    IMDSv2 (token, role credentials, instance identity document)
+  port 8081  STS GetCallerIdentity and SSM Get/PutParameter
+  port 8082  path style S3 (get, put, head, delete, list-objects-v2)
+  port 8080  artifact cache, git repositories over dumb http and the GitHub statuses API
+
+Artifacts are requested as /<host>/<path> and served from the artifacts directory,
+fetching https://<host>/<path> on a miss when fetching is enabled.
+"""
+import argparse
+import datetime
+import json
+import os
+import threading
+import urllib.request
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+ACCOUNT = "123456789012"
+ROLE = "ec2-dev-bench-role"
+INSTANCE_ID = "i-0123456789abcdef0"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, code, body=b"", content_type="text/plain", headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+class ImdsHandler(Handler):
+    def do_PUT(self):
+        if self.path == "/latest/api/token":
+            return self.reply(200, "bench-imds-token")
+        self.reply(404)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        now = datetime.datetime.utcnow()
+        credentials_path = "/latest/meta-data/iam/security-credentials/"
+        if path == credentials_path:
+            return self.reply(200, ROLE)
+        if path.startswith(credentials_path):
+            return self.reply(200, json.dumps({
+                "Code": "Success",
+                "LastUpdated": now.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "Type": "AWS-HMAC",
+                "AccessKeyId": "ASIABENCHACCESSKEY00",
+                "SecretAccessKey": "bench-secret-access-key",
+                "Token": "bench-session-token",
+                "Expiration": (now + datetime.timedelta(hours=6)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }), "application/json")
+        if path == "/latest/dynamic/instance-identity/document":
+            return self.reply(200, json.dumps({
+                "accountId": ACCOUNT,
+                "instanceId": INSTANCE_ID,
+                "region": self.state.region,
+                "availabilityZone": f"{self.state.region}a",
+                "instanceType": "t3.large",
+            }), "application/json")
+        meta_data = {
+            "/latest/meta-data/instance-id": INSTANCE_ID,
+            "/latest/meta-data/placement/region": self.state.region,
+            "/latest/meta-data/placement/availability-zone": f"{self.state.region}a",
+            "/latest/meta-data/instance-type": "t3.large",
+        }
+        if path in meta_data:
+            return self.reply(200, meta_data[path])
+        self.reply(404)
+
+
+class ApiHandler(Handler):
+    def do_POST(self):
+        body = self.read_body()
+        target = self.headers.get("X-Amz-Target", "")
+        if target.startswith("AmazonSSM."):
+            return self.ssm(target.split(".", 1)[1], json.loads(body or b"{}"))
+        params = parse_qs(body.decode())
+        if params.get("Action") == ["GetCallerIdentity"]:
+            return self.reply(200, f"""<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <GetCallerIdentityResult>
+    <Arn>arn:aws:sts::{ACCOUNT}:assumed-role/{ROLE}/{INSTANCE_ID}</Arn>
+    <UserId>AROABENCH:{INSTANCE_ID}</UserId>
+    <Account>{ACCOUNT}</Account>
+  </GetCallerIdentityResult>
+  <ResponseMetadata><RequestId>bench</RequestId></ResponseMetadata>
+</GetCallerIdentityResponse>""", "text/xml")
+        self.reply(400, json.dumps({"__type": "UnknownOperationException"}), "application/x-amz-json-1.1")
+
+    def ssm(self, operation, request):
+        parameters = self.state.parameters
+        if operation == "GetParameter":
+            name = request["Name"]
+            if name not in parameters:
+                return self.reply(400, json.dumps({"__type": "ParameterNotFound"}), "application/x-amz-json-1.1")
+            return self.reply(200, json.dumps({
+                "Parameter": {"Name": name, "Type": "String", "Value": parameters[name], "Version": 1}
+            }), "application/x-amz-json-1.1")
+        if operation == "PutParameter":
+            parameters[request["Name"]] = request["Value"]
+            return self.reply(200, json.dumps({"Version": 1}), "application/x-amz-json-1.1")
+        self.reply(400, json.dumps({"__type": "UnknownOperationException"}), "application/x-amz-json-1.1")
+
+
+class S3Handler(Handler):
+    def locate(self):
+        url = urlparse(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        return bucket, key, parse_qs(url.query), os.path.join(self.state.s3_dir, bucket, key)
+
+    def do_GET(self):
+        bucket, key, query, path = self.locate()
+        if not key:
+            return self.list_objects(bucket, query.get("prefix", [""])[0])
+        if not os.path.isfile(path):
+            return self.reply(404, "<Error><Code>NoSuchKey</Code></Error>", "application/xml")
+        with open(path, "rb") as f:
+            body = f.read()
+        self.reply(200, body, "application/octet-stream", {
+            "Last-Modified": formatdate(os.path.getmtime(path), usegmt=True),
+            "ETag": f'"{len(body)}-{int(os.path.getmtime(path))}"',
+        })
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        bucket, key, _, path = self.locate()
+        body = self.read_body()
+        if key:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(body)
+        else:
+            os.makedirs(path, exist_ok=True)
+        self.reply(200, headers={"ETag": '"bench"'})
+
+    def do_DELETE(self):
+        _, _, _, path = self.locate()
+        if os.path.isfile(path):
+            os.remove(path)
+        self.reply(204)
+
+    def list_objects(self, bucket, prefix):
+        root = os.path.join(self.state.s3_dir, bucket)
+        contents = []
+        for directory, _, files in os.walk(root):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, root)
+                if key.startswith(prefix):
+                    modified = datetime.datetime.utcfromtimestamp(os.path.getmtime(path))
+                    contents.append(
+                        f"<Contents><Key>{escape(key)}</Key><Size>{os.path.getsize(path)}</Size>"
+                        f"<LastModified>{modified.strftime('%Y-%m-%dT%H:%M:%S.000Z')}</LastModified>"
+                        f"<ETag>\"bench\"</ETag><StorageClass>STANDARD</StorageClass></Contents>"
+                    )
+        self.reply(200, f"""<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(contents)}</KeyCount>
+<MaxKeys>1000</MaxKeys><IsTruncated>false</IsTruncated>{"".join(sorted(contents))}
+</ListBucketResult>""", "application/xml")
+
+
+class ArtifactHandler(Handler):
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path).lstrip("/")
+        if path == "bench/statuses":
+            return self.reply(200, json.dumps(self.state.statuses), "application/json")
+        if path == "bench/counters":
+            return self.reply(200, json.dumps(self.state.counters), "application/json")
+        if path.startswith("git/"):
+            return self.send_file(os.path.join(self.state.git_dir, path[len("git/"):]))
+
+        local = os.path.join(self.state.artifacts_dir, path)
+        if os.path.isfile(local):
+            self.state.count("artifact_hits")
+            return self.send_file(local)
+        if not self.state.fetch:
+            self.state.count("artifact_misses")
+            return self.reply(404)
+
+        self.state.count("artifact_fetches")
+        try:
+            with urllib.request.urlopen(f"https://{path}") as response:
+                body = response.read()
+        except Exception as e:
+            return self.reply(502, str(e))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "wb") as f:
+            f.write(body)
+        self.reply(200, body, "application/octet-stream")
+
+    def send_file(self, path):
+        if not os.path.isfile(path):
+            return self.reply(404)
+        with open(path, "rb") as f:
+            self.reply(200, f.read(), "application/octet-stream")
+
+    def do_POST(self):
+        body = self.read_body()
+        self.state.statuses.append({"path": self.path, "body": json.loads(body or b"{}")})
+        self.reply(201, "{}", "application/json")
+
+
+class State:
+    def __init__(self, args):
+        self.region = args.region
+        self.s3_dir = args.s3_dir
+        self.artifacts_dir = args.artifacts_dir
+        self.git_dir = args.git_dir
+        self.fetch = args.fetch
+        self.verbose = args.verbose
+        self.parameters = {}
+        if args.ssm_params:
+            with open(args.ssm_params) as f:
+                self.parameters = json.load(f)
+        self.statuses = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+
+def serve(address, port, handler, state):
+    handler_class = type(handler.__name__, (handler,), {"state": state})
+    return ThreadingHTTPServer((address, port), handler_class)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--address", default="0.0.0.0")
+    parser.add_argument("--region", default="eu-west-1")
+    parser.add_argument("--s3-dir", default="/data/s3")
+    parser.add_argument("--artifacts-dir", default="/data/artifacts")
+    parser.add_argument("--git-dir", default="/data/git")
+    parser.add_argument("--ssm-params", help="json file of ssm parameter names to values")
+    parser.add_argument("--fetch", action="store_true", help="fetch and store artifacts that are not in the artifacts directory")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    state = State(args)
+    for port, handler in ((8081, ApiHandler), (8082, S3Handler), (8080, ArtifactHandler)):
+        server = serve(args.address, port, handler, state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    imds = serve(args.address, 80, ImdsHandler, state)
+    print("fake aws endpoints ready", flush=True)
+    imds.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
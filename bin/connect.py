@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""Connect to a stack's instance over SSH tunnelled through SSM.
+
+  connect.py ssh ec2-dev-one [ssh arguments]   shell or command on the instance
+  connect.py forward ec2-dev-one 8080:localhost:8080
+                                               add a local port forward
+  connect.py config ec2-dev-one >> ~/.ssh/config
+                                               so ssh, scp and rsync can use ec2-dev-one as a host
+  connect.py exit ec2-dev-one                  close the shared connection
+  connect.py resolve ec2-dev-one               print the cached instance details
+
+The stack's instance id is cached in ~/.cache/ec2-dev/stacks.json and only looked
+up with pulumi again when the stack's state in the pulumi backend changes, or when
+the cached instance no longer exists. A stopped instance is started. The first
+connection becomes an SSH ControlMaster that later connections share, so while it
+is open they need no AWS calls and no new SSM session. The instance needs an
+ssh-key-name whose private key is loaded in ssh-agent or given with
+--identity-file, and the session-manager-plugin must be installed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+DEPLOY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "aws-deploy")
+CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ec2-dev")
+USER = "ec2-user"
+# States of an instance that was replaced or destroyed
+GONE_STATES = ("terminated", "shutting-down", "not-found")
+
+
+def ssm_proxy_command(instance_id, region, port="%p"):
+    command = [
+        "aws", "ssm", "start-session", "--target", instance_id,
+        "--document-name", "AWS-StartSSHSession", "--parameters", f"portNumber={port}",
+    ]
+    if region:
+        command += ["--region", region]
+    return command
+
+
+class AwsCli:
+    """The EC2, SSM and S3 calls needed, made with the AWS CLI."""
+
+    def __init__(self, region=None):
+        self.region = region
+
+    def call(self, *args):
+        command = ["aws", "--output", "json"] + list(args)
+        if self.region:
+            command += ["--region", self.region]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise Exception(f"{' '.join(command[3:5])} failed: {result.stderr.strip()}")
+        return json.loads(result.stdout or "{}")
+
+    def describe_instance(self, instance_id):
+        instance = self.call("ec2", "describe-instances", "--instance-ids", instance_id)["Reservations"][0]["Instances"][0]
+        return {
+            "state": instance["State"]["Name"],
+            "private_ip": instance.get("PrivateIpAddress"),
+            "public_ip": instance.get("PublicIpAddress"),
+        }
+
+    def start_instance(self, instance_id):
+        self.call("ec2", "start-instances", "--instance-ids", instance_id)
+
+    def ssm_online(self, instance_id):
+        information = self.call(
+            "ssm", "describe-instance-information", "--filters", f"Key=InstanceIds,Values={instance_id}",
+        )["InstanceInformationList"]
+        return bool(information) and information[0]["PingStatus"] == "Online"
+
+    def object_version(self, bucket, key):
+        try:
+            return self.call("s3api", "head-object", "--bucket", bucket, "--key", key)["ETag"]
+        except Exception:
+            return None
+
+
+class StackCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, stack):
+        return self.entries.get(stack)
+
+    def put(self, stack, entry):
+        self.entries[stack] = entry
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def delete(self, stack):
+        if stack in self.entries:
+            del self.entries[stack]
+            self.save()
+
+
+def backend_url():
+    url = os.getenv("PULUMI_BACKEND_URL")
+    if url:
+        return url
+    try:
+        with open(os.path.expanduser("~/.pulumi/credentials.json")) as f:
+            return json.load(f).get("current")
+    except (OSError, ValueError):
+        return None
+
+
+def pulumi_instance_id(stack):
+    result = subprocess.run(
+        ["pulumi", "stack", "output", "instance", "--stack", stack],
+        cwd=DEPLOY_DIR, stdout=subprocess.PIPE, universal_newlines=True,
+    )
+    if result.returncode != 0 or not result.stdout.strip():
+        raise Exception(f"unable to read the instance id of stack {stack}, is the pulumi backend logged in?")
+    return result.stdout.strip()
+
+
+def stack_region(stack):
+    path = os.path.join(DEPLOY_DIR, f"Pulumi.{stack}.yaml")
+    if not os.path.exists(path):
+        return None
+    # PyYAML is installed with pulumi
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f).get("config", {})
+    return config.get("ec2-dev:networking", {}).get("region") or config.get("aws:region")
+
+
+class Connector:
+    """Resolves stacks to running instances and shares one SSH connection per instance.
+
+    aws provides describe_instance, start_instance, ssm_online and object_version,
+    see AwsCli. resolve_instance looks up a stack's instance id and run runs ssh,
+    so both can be replaced to exercise the caching and multiplexing without AWS.
+    """
+
+    def __init__(self, aws, cache, backend=None, resolve_instance=pulumi_instance_id, run=subprocess.run,
+                 sleep=time.sleep, identity_file=None, persist="1h", timeout=300):
+        self.aws = aws
+        self.cache = cache
+        self.backend = backend
+        self.resolve_instance = resolve_instance
+        self.run = run
+        self.sleep = sleep
+        self.identity_file = identity_file
+        self.persist = persist
+        self.timeout = timeout
+
+    def state_version(self, stack):
+        """Changes whenever the stack is updated, None if that can't be told."""
+        if not self.backend:
+            return None
+        url = urlparse(self.backend)
+        for key in (f".pulumi/stacks/{stack}.json", f".pulumi/stacks/ec2-dev/{stack}.json"):
+            if url.scheme == "s3":
+                version = self.aws.object_version(url.netloc, "/".join(filter(None, [url.path.strip("/"), key])))
+            elif url.scheme == "file":
+                path = os.path.join(os.path.expanduser(url.netloc + url.path), key)
+                version = str(os.stat(path).st_mtime_ns) if os.path.exists(path) else None
+            else:
+                return None
+            if version is not None:
+                return version
+        return None
+
+    def resolve(self, stack, refresh=False):
+        entry = self.cache.get(stack)
+        version = self.state_version(stack)
+        if entry and not refresh and (version is None or entry["state_version"] == version):
+            return entry
+        entry = {"instance_id": self.resolve_instance(stack), "state_version": version}
+        self.cache.put(stack, entry)
+        return entry
+
+    def describe_instance(self, instance_id):
+        try:
+            return self.aws.describe_instance(instance_id)
+        except Exception as e:
+            # Terminated instances are only described for about an hour
+            if "InvalidInstanceID.NotFound" not in str(e):
+                raise
+            return {"state": "not-found", "private_ip": None, "public_ip": None}
+
+    def ensure_running(self, stack, entry):
+        deadline = time.time() + self.timeout
+        started = False
+        refreshed = False
+        while True:
+            instance = self.describe_instance(entry["instance_id"])
+            if instance["state"] == "running":
+                break
+            if instance["state"] in GONE_STATES:
+                if refreshed:
+                    raise Exception(f"instance {entry['instance_id']} of stack {stack} is {instance['state']}, run pulumi up")
+                # The cached id can outlive the instance when the backend's state version is unknown
+                self.cache.delete(stack)
+                entry = self.resolve(stack, refresh=True)
+                refreshed = True
+                continue
+            if instance["state"] == "stopped" and not started:
+                print(f"starting instance {entry['instance_id']}", file=sys.stderr)
+                self.aws.start_instance(entry["instance_id"])
+                started = True
+            if time.time() > deadline:
+                raise Exception(f"instance {entry['instance_id']} is still {instance['state']}")
+            self.sleep(5)
+
+        # Addresses can change when the instance is started
+        if instance["private_ip"] != entry.get("private_ip") or instance["public_ip"] != entry.get("public_ip"):
+            entry = dict(entry, private_ip=instance["private_ip"], public_ip=instance["public_ip"])
+            self.cache.put(stack, entry)
+
+        while not self.aws.ssm_online(entry["instance_id"]):
+            if time.time() > deadline:
+                raise Exception(f"ssm agent on instance {entry['instance_id']} is not online")
+            self.sleep(5)
+        return entry
+
+    def control_path(self, stack):
+        return os.path.join(CACHE_DIR, "ssh", stack)
+
+    def ssh_settings(self, stack):
+        return [
+            ("ControlMaster", "auto"),
+            ("ControlPath", self.control_path(stack)),
+            ("ControlPersist", self.persist),
+            # The SSM session already authenticates the instance, and host keys change when it is replaced
+            ("StrictHostKeyChecking", "no"),
+            ("UserKnownHostsFile", "/dev/null"),
+            ("LogLevel", "ERROR"),
+        ]
+
+    def ssh_options(self, stack, entry):
+        settings = self.ssh_settings(stack)
+        settings.append(("ProxyCommand", " ".join(ssm_proxy_command(entry["instance_id"], self.aws.region))))
+        options = [option for name, value in settings for option in ("-o", f"{name}={value}")]
+        if self.identity_file:
+            options += ["-i", self.identity_file]
+        return options
+
+    def master_alive(self, stack):
+        if not os.path.exists(self.control_path(stack)):
+            return False
+        result = self.run(
+            ["ssh", "-O", "check", "-o", f"ControlPath={self.control_path(stack)}", stack],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return result.returncode == 0
+
+    def ssh_command(self, stack, args=(), refresh=False):
+        """The ssh command line for the stack, starting the instance if needed unless a connection is open."""
+        os.makedirs(os.path.dirname(self.control_path(stack)), mode=0o700, exist_ok=True)
+        # The cached instance's ProxyCommand is still given while a connection is open,
+        # in case it closes before ssh runs
+        entry = self.cache.get(stack)
+        if refresh or entry is None or not self.master_alive(stack):
+            entry = self.ensure_running(stack, self.resolve(stack, refresh))
+        return ["ssh"] + self.ssh_options(stack, entry) + [f"{USER}@{stack}"] + list(args)
+
+    def open_master(self, stack, refresh=False):
+        if refresh or not self.master_alive(stack):
+            result = self.run(self.ssh_command(stack, ["-f", "-N"], refresh))
+            if result.returncode != 0:
+                raise Exception(f"unable to connect to stack {stack}")
+
+    def forward(self, stack, spec, remote=False):
+        self.open_master(stack)
+        result = self.run(["ssh", "-O", "forward", "-R" if remote else "-L", spec, "-o", f"ControlPath={self.control_path(stack)}", stack])
+        if result.returncode != 0:
+            raise Exception(f"unable to forward {spec}")
+
+    def exit(self, stack):
+        if self.master_alive(stack):
+            self.run(["ssh", "-O", "exit", "-o", f"ControlPath={self.control_path(stack)}", stack], stderr=subprocess.DEVNULL)
+
+    def ssh_config(self, stack):
+        lines = [
+            f"Host {stack}",
+            f"  User {USER}",
+            f"  ProxyCommand {os.path.abspath(__file__)} proxy {stack} %p",
+        ]
+        lines += [f"  {name} {value}" for name, value in self.ssh_settings(stack)]
+        if self.identity_file:
+            lines.append(f"  IdentityFile {os.path.abspath(self.identity_file)}")
+        return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--region", help="defaults to the stack configuration or AWS_REGION")
+    parser.add_argument("--identity-file", help="private key of the instance's ssh-key-name")
+    parser.add_argument("--persist", default="1h", help="how long the shared connection stays open after the last session")
+    parser.add_argument("--refresh", action="store_true", help="look up the instance again and open a new connection")
+    commands = parser.add_subparsers(dest="command")
+    ssh = commands.add_parser("ssh")
+    ssh.add_argument("stack")
+    ssh.add_argument("args", nargs=argparse.REMAINDER)
+    forward = commands.add_parser("forward")
+    forward.add_argument("stack")
+    forward.add_argument("spec", help="[bind_address:]port:host:hostport, as for ssh -L")
+    forward.add_argument("--remote", action="store_true", help="forward a remote port, as for ssh -R")
+    for name in ("config", "exit", "resolve"):
+        commands.add_parser(name).add_argument("stack")
+    proxy = commands.add_parser("proxy", help="ProxyCommand used by the ssh config")
+    proxy.add_argument("stack")
+    proxy.add_argument("port")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+
+    region = args.region or stack_region(args.stack) or os.getenv("AWS_REGION")
+    connector = Connector(
+        AwsCli(region), StackCache(os.path.join(CACHE_DIR, "stacks.json")), backend_url(),
+        identity_file=args.identity_file, persist=args.persist,
+    )
+
+    if args.command == "ssh":
+        command = connector.ssh_command(args.stack, args.args, args.refresh)
+        os.execvp(command[0], command)
+    elif args.command == "forward":
+        connector.forward(args.stack, args.spec, args.remote)
+    elif args.command == "config":
+        print(connector.ssh_config(args.stack))
+    elif args.command == "exit":
+        connector.exit(args.stack)
+    elif args.command == "resolve":
+        print(json.dumps(connector.resolve(args.stack, args.refresh), indent=1))
+    elif args.command == "proxy":
+        entry = connector.ensure_running(args.stack, connector.resolve(args.stack, args.refresh))
+        command = ssm_proxy_command(entry["instance_id"], region, args.port)
+        os.execvp(command[0], command)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"connect.py: {e}", file=sys.stderr)
+        sys.exit(1)
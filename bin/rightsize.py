@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""Recommend an instance-type and root-vol-type for a stack from recorded utilization.
+
+Utilization is read from CloudWatch with the AWS CLI, or from a file: either a
+recording made with --record, or the samples file written by the telemetry agent
+(/var/log/ec2-dev-telemetry/samples.jsonl). The metrics are compared with the
+instance and volume specs below to find the cheapest instance type and volume
+type that give the observed load headroom, and the expected effect on build time
+and monthly cost is reported.
+
+  rightsize.py --stack ec2-dev-one
+  rightsize.py --stack ec2-dev-one --days 7 --record utilization.json
+  rightsize.py --stack ec2-dev-one --metrics-file utilization.json
+  rightsize.py --instance-type t3.large --metrics-file samples.jsonl
+
+Build time estimates assume CPU bound phases scale with the number of vCPUs and IO
+bound phases with the volume's IOPS; differences between processor generations
+are not modelled. Prices are us-east-1 on-demand Linux list prices, override them
+with --specs for other regions.
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+DEPLOY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "aws-deploy")
+
+# Defaults match ServerComponent
+DEFAULT_INSTANCE_TYPE = "t2.micro"
+DEFAULT_ROOT_VOLUME_TYPE = "gp2"
+DEFAULT_ROOT_VOLUME_SIZE = 40
+
+# vCPUs, memory GiB, baseline percent per vCPU for burstable types, USD per hour
+INSTANCE_SPECS = {
+    "t2.micro": (1, 1, 10, 0.0116),
+    "t2.small": (1, 2, 20, 0.023),
+    "t2.medium": (2, 4, 20, 0.0464),
+    "t2.large": (2, 8, 30, 0.0928),
+    "t2.xlarge": (4, 16, 22.5, 0.1856),
+    "t2.2xlarge": (8, 32, 17, 0.3712),
+    "t3.micro": (2, 1, 10, 0.0104),
+    "t3.small": (2, 2, 20, 0.0208),
+    "t3.medium": (2, 4, 20, 0.0416),
+    "t3.large": (2, 8, 30, 0.0832),
+    "t3.xlarge": (4, 16, 40, 0.1664),
+    "t3.2xlarge": (8, 32, 40, 0.3328),
+    "t3a.medium": (2, 4, 20, 0.0376),
+    "t3a.large": (2, 8, 30, 0.0752),
+    "t3a.xlarge": (4, 16, 40, 0.1504),
+    "t3a.2xlarge": (8, 32, 40, 0.3008),
+    "m5.large": (2, 8, None, 0.096),
+    "m5.xlarge": (4, 16, None, 0.192),
+    "m5.2xlarge": (8, 32, None, 0.384),
+    "m5.4xlarge": (16, 64, None, 0.768),
+    "m6i.large": (2, 8, None, 0.096),
+    "m6i.xlarge": (4, 16, None, 0.192),
+    "m6i.2xlarge": (8, 32, None, 0.384),
+    "m6i.4xlarge": (16, 64, None, 0.768),
+    "c5.large": (2, 4, None, 0.085),
+    "c5.xlarge": (4, 8, None, 0.17),
+    "c5.2xlarge": (8, 16, None, 0.34),
+    "c5.4xlarge": (16, 32, None, 0.68),
+    "c6i.large": (2, 4, None, 0.085),
+    "c6i.xlarge": (4, 8, None, 0.17),
+    "c6i.2xlarge": (8, 16, None, 0.34),
+    "c6i.4xlarge": (16, 32, None, 0.68),
+    "r5.large": (2, 16, None, 0.126),
+    "r5.xlarge": (4, 32, None, 0.252),
+    "r5.2xlarge": (8, 64, None, 0.504),
+}
+
+# USD per GB month
+VOLUME_PRICES = {"gp2": 0.10, "gp3": 0.08, "standard": 0.05}
+
+# t2 instances default to standard credits and are throttled to their baseline, t3 and
+# t3a default to unlimited and are charged for surplus credits instead
+SURPLUS_PRICE_PER_VCPU_HOUR = 0.05
+THROTTLED_FAMILIES = ("t2",)
+
+HOURS_PER_MONTH = 730
+
+# Load above this share of capacity is treated as saturated, i.e. the work was waiting on it
+SATURATED_PERCENT = 90
+# Recommended types keep the 95th percentile of load below this share of capacity
+HEADROOM_PERCENT = 80
+# Samples with less load than this are idle time and not part of a build
+ACTIVE_PERCENT = 10
+MIN_SAMPLES = 12
+
+
+def volume_iops(volume_type, size, burst=True):
+    if volume_type == "gp3":
+        return 3000
+    if volume_type == "gp2":
+        baseline = min(max(100, 3 * size), 16000)
+        return max(baseline, 3000) if burst and size < 1000 else baseline
+    # Magnetic volumes manage around a hundred IOPS
+    return 100
+
+
+class Sample:
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.cpu_percent = None
+        self.cpu_credit_balance = None
+        self.memory_used_percent = None
+        self.iops = None
+        self.disk_busy_percent = None
+        self.burst_balance = None
+
+
+class Utilization:
+    """Samples at a fixed period and ci run spans, from CloudWatch, a recording or telemetry samples."""
+
+    def __init__(self, period, samples, ci_runs, instance=None):
+        self.period = period
+        self.samples = sorted(samples, key=lambda s: s.timestamp)
+        self.ci_runs = ci_runs
+        self.instance = instance or {}
+
+    @classmethod
+    def from_metric_data(cls, recording):
+        samples = {}
+
+        def sample(timestamp):
+            if isinstance(timestamp, str):
+                timestamp = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()
+            return samples.setdefault(timestamp, Sample(timestamp))
+
+        period = recording["Period"]
+        ci_runs = []
+        for result in recording["MetricDataResults"]:
+            for timestamp, value in zip(result["Timestamps"], result["Values"]):
+                s = sample(timestamp)
+                metric = result["Id"]
+                if metric == "cpu":
+                    s.cpu_percent = value
+                elif metric == "credits":
+                    s.cpu_credit_balance = value
+                elif metric == "memory":
+                    s.memory_used_percent = value
+                elif metric in ("readops", "writeops"):
+                    s.iops = (s.iops or 0) + value / period
+                elif metric == "idle":
+                    s.disk_busy_percent = max(0.0, 100.0 * (1 - value / period))
+                elif metric == "burst":
+                    s.burst_balance = value
+                elif metric == "ci":
+                    ci_runs.append((s.timestamp - value, s.timestamp))
+        # Datapoints of other metrics can exist while the instance is stopped
+        running = [s for s in samples.values() if s.cpu_percent is not None]
+        return cls(period, running, ci_runs, recording.get("Instance"))
+
+    @classmethod
+    def from_telemetry(cls, lines):
+        samples = []
+        ci_runs = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            host = record["host"]
+            for span in record.get("spans", []):
+                if span.get("name") == "ci":
+                    ci_runs.append((span["start"], span["end"]))
+            # The first sample after the agent starts has no rates
+            if "cpu_idle_percent" not in host:
+                continue
+            s = Sample(record["timestamp"])
+            s.cpu_percent = 100.0 - host["cpu_idle_percent"]
+            s.memory_used_percent = host.get("memory_used_percent")
+            disks = record.get("disks", [])
+            ops = [disk[name] for disk in disks for name in ("disk_read_per_second", "disk_write_per_second") if name in disk]
+            busy = [disk["disk_busy_percent"] for disk in disks if "disk_busy_percent" in disk]
+            s.iops = sum(ops) if ops else None
+            s.disk_busy_percent = max(busy) if busy else None
+            samples.append(s)
+        timestamps = sorted(s.timestamp for s in samples)
+        period = statistics.median(b - a for a, b in zip(timestamps, timestamps[1:])) if len(timestamps) > 1 else 60
+        return cls(period, samples, ci_runs)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            text = f.read()
+        try:
+            recording = json.loads(text)
+        except ValueError:
+            recording = None
+        if isinstance(recording, dict) and "MetricDataResults" in recording:
+            return cls.from_metric_data(recording)
+        return cls.from_telemetry(text.splitlines())
+
+    def build_samples(self):
+        """Samples during ci runs if any were recorded, otherwise all samples with some load."""
+        if self.ci_runs:
+            during = [s for s in self.samples if any(start - self.period <= s.timestamp <= end for start, end in self.ci_runs)]
+            if during:
+                return during
+        return [
+            s for s in self.samples
+            if s.cpu_percent >= ACTIVE_PERCENT or (s.disk_busy_percent or 0) >= ACTIVE_PERCENT
+        ]
+
+    def running_hours_per_month(self):
+        days = (self.samples[-1].timestamp - self.samples[0].timestamp + self.period) / 86400
+        running_hours = len(self.samples) * self.period / 3600
+        return min(HOURS_PER_MONTH, running_hours / (days * 24) * HOURS_PER_MONTH)
+
+
+def aws(*args, region=None):
+    command = ["aws", "--output", "json"] + list(args)
+    if region:
+        command += ["--region", region]
+    result = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception(f"{' '.join(command[:4])} failed")
+    return json.loads(result.stdout or "{}")
+
+
+def stack_instance_id(stack):
+    result = subprocess.run(
+        ["pulumi", "stack", "output", "instance", "--stack", stack],
+        cwd=DEPLOY_DIR, stdout=subprocess.PIPE, universal_newlines=True,
+    )
+    if result.returncode != 0 or not result.stdout.strip():
+        raise Exception(f"unable to read the instance id of stack {stack}, is the pulumi backend logged in?")
+    return result.stdout.strip()
+
+
+def stack_server_config(stack):
+    path = os.path.join(DEPLOY_DIR, f"Pulumi.{stack}.yaml")
+    if not os.path.exists(path):
+        return {}
+    # PyYAML is installed with pulumi
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f).get("config", {})
+    return config.get("ec2-dev:server", {})
+
+
+def describe_instance(instance_id, region):
+    reservations = aws("ec2", "describe-instances", "--instance-ids", instance_id, region=region)["Reservations"]
+    instance = reservations[0]["Instances"][0]
+    root = [m for m in instance["BlockDeviceMappings"] if m["DeviceName"] == instance["RootDeviceName"]]
+    volume_id = root[0]["Ebs"]["VolumeId"]
+    volume = aws("ec2", "describe-volumes", "--volume-ids", volume_id, region=region)["Volumes"][0]
+    return {
+        "InstanceId": instance_id,
+        "InstanceType": instance["InstanceType"],
+        "RootVolumeId": volume_id,
+        "RootVolumeType": volume["VolumeType"],
+        "RootVolumeSize": volume["Size"],
+    }
+
+
+def get_metric_data(instance, days, period, namespace, region):
+    def query(id, metric_namespace, name, dimensions, stat):
+        return {
+            "Id": id,
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": metric_namespace,
+                    "MetricName": name,
+                    "Dimensions": [{"Name": key, "Value": value} for key, value in dimensions.items()],
+                },
+                "Period": period,
+                "Stat": stat,
+            },
+        }
+
+    ec2 = {"InstanceId": instance["InstanceId"]}
+    ebs = {"VolumeId": instance["RootVolumeId"]}
+    queries = [
+        query("cpu", "AWS/EC2", "CPUUtilization", ec2, "Average"),
+        query("credits", "AWS/EC2", "CPUCreditBalance", ec2, "Minimum"),
+        query("readops", "AWS/EBS", "VolumeReadOps", ebs, "Sum"),
+        query("writeops", "AWS/EBS", "VolumeWriteOps", ebs, "Sum"),
+        query("idle", "AWS/EBS", "VolumeIdleTime", ebs, "Sum"),
+        query("burst", "AWS/EBS", "BurstBalance", ebs, "Minimum"),
+        # Published by the telemetry agent when enabled
+        query("memory", namespace, "memory_used_percent", ec2, "Average"),
+        query("ci", namespace, "job_duration_seconds", dict(ec2, Job="ci"), "Maximum"),
+    ]
+    end = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+    start = end - datetime.timedelta(days=days)
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(queries, f)
+        f.flush()
+        response = aws(
+            "cloudwatch", "get-metric-data",
+            "--metric-data-queries", f"file://{f.name}",
+            "--start-time", start.isoformat(), "--end-time", end.isoformat(),
+            region=region,
+        )
+    return {"Instance": instance, "Period": period, "MetricDataResults": response["MetricDataResults"]}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def cpu_capacity(instance_type, throttled):
+    vcpus, _, baseline, _ = INSTANCE_SPECS[instance_type]
+    if throttled and baseline is not None:
+        return vcpus * baseline / 100
+    return vcpus
+
+
+def estimate(utilization, current, instance_type, volume_type, volume_size):
+    """Expected build time factor and monthly cost of running the recorded load on instance_type and volume_type."""
+    vcpus, memory, baseline, price = INSTANCE_SPECS[instance_type]
+    family = instance_type.split(".")[0]
+    current_vcpus = INSTANCE_SPECS[current["instance_type"]][0]
+    current_family = current["instance_type"].split(".")[0]
+
+    factors = []
+    for s in utilization.build_samples():
+        # Out of credits on a throttled type means the instance was held at its baseline
+        throttled = s.cpu_credit_balance is not None and s.cpu_credit_balance < 1 and current_family in THROTTLED_FAMILIES
+        current_cpu = cpu_capacity(current["instance_type"], throttled)
+        # Other types that fit() keep within their baseline, so they keep their credits
+        new_cpu = current_cpu if instance_type == current["instance_type"] else vcpus
+        demand = s.cpu_percent * current_vcpus / 100
+        cpu_saturated = demand >= current_cpu * SATURATED_PERCENT / 100
+        cpu_factor = current_cpu / new_cpu if cpu_saturated else max(1.0, demand / new_cpu)
+
+        io_saturated = False
+        io_factor = 1.0
+        if s.iops is not None:
+            current_iops = volume_iops(current["volume_type"], current["volume_size"], burst=not (s.burst_balance is not None and s.burst_balance < 1))
+            new_iops = current_iops if volume_type == current["volume_type"] else volume_iops(volume_type, volume_size)
+            io_saturated = (s.disk_busy_percent or 0) >= SATURATED_PERCENT or s.iops >= current_iops * SATURATED_PERCENT / 100
+            io_factor = current_iops / new_iops if io_saturated else max(1.0, s.iops / new_iops)
+
+        saturated = [f for f, bound in ((cpu_factor, cpu_saturated), (io_factor, io_saturated)) if bound]
+        slower = [f for f, bound in ((cpu_factor, cpu_saturated), (io_factor, io_saturated)) if not bound and f > 1]
+        factors.append(max(saturated + slower) if saturated or slower else 1.0)
+
+    hours = utilization.running_hours_per_month()
+    cost = price * hours + VOLUME_PRICES.get(volume_type, VOLUME_PRICES["gp2"]) * volume_size
+    if baseline is not None and family not in THROTTLED_FAMILIES:
+        demands = [min(s.cpu_percent * current_vcpus / 100, vcpus) for s in utilization.samples]
+        surplus = max(0.0, statistics.mean(demands) - vcpus * baseline / 100)
+        cost += surplus * hours * SURPLUS_PRICE_PER_VCPU_HOUR
+
+    return {
+        "instance_type": instance_type,
+        "volume_type": volume_type,
+        "build_time_factor": statistics.mean(factors) if factors else 1.0,
+        "monthly_cost": cost,
+        "memory_gib": memory,
+        "vcpus": vcpus,
+    }
+
+
+def fits(utilization, current, instance_type):
+    """Whether instance_type has headroom for the recorded load."""
+    vcpus, memory, baseline, _ = INSTANCE_SPECS[instance_type]
+    current_vcpus, current_memory, _, _ = INSTANCE_SPECS[current["instance_type"]]
+    samples = utilization.build_samples() or utilization.samples
+
+    demands = [s.cpu_percent * current_vcpus / 100 for s in samples]
+    if percentile(demands, 95) > vcpus * HEADROOM_PERCENT / 100:
+        return False
+    if baseline is not None and instance_type.split(".")[0] in THROTTLED_FAMILIES:
+        average = statistics.mean(s.cpu_percent * current_vcpus / 100 for s in utilization.samples)
+        if average > vcpus * baseline / 100 * HEADROOM_PERCENT / 100:
+            return False
+
+    memory_used = [s.memory_used_percent * current_memory / 100 for s in samples if s.memory_used_percent is not None]
+    if memory_used:
+        return percentile(memory_used, 95) <= memory * HEADROOM_PERCENT / 100
+    # Without memory data never recommend less memory
+    return memory >= current_memory
+
+
+def recommend(utilization, current, families=None):
+    if len(utilization.samples) < MIN_SAMPLES:
+        raise Exception(f"only {len(utilization.samples)} utilization samples, at least {MIN_SAMPLES} are needed")
+    if current["instance_type"] not in INSTANCE_SPECS:
+        raise Exception(f"no specs for instance type {current['instance_type']}, add them with --specs")
+
+    volume_types = {current["volume_type"]}
+    if current["volume_type"] in VOLUME_PRICES:
+        volume_types.add("gp3")
+    volumes = [estimate(utilization, current, current["instance_type"], volume_type, current["volume_size"]) for volume_type in volume_types]
+    # A volume type that is cheaper and at least as fast, i.e. gp3 over gp2 below 1000GB
+    volume = min(volumes, key=lambda e: (round(e["build_time_factor"], 2), e["monthly_cost"]))["volume_type"]
+
+    candidates = []
+    for instance_type in INSTANCE_SPECS:
+        if families and instance_type.split(".")[0] not in families and instance_type != current["instance_type"]:
+            continue
+        if fits(utilization, current, instance_type):
+            candidates.append(estimate(utilization, current, instance_type, volume, current["volume_size"]))
+    if not candidates:
+        raise Exception("no instance type in the specs fits the recorded load")
+
+    # Cheapest type that fits, unless the load was held back by the current type, then the fastest per dollar
+    current_estimate = estimate(utilization, current, current["instance_type"], current["volume_type"], current["volume_size"])
+    faster = [c for c in candidates if c["build_time_factor"] < 0.95]
+    if faster:
+        candidates.sort(key=lambda c: c["monthly_cost"] * c["build_time_factor"])
+    else:
+        candidates.sort(key=lambda c: c["monthly_cost"])
+    return current_estimate, candidates
+
+
+def report(utilization, current, current_estimate, candidates):
+    best = candidates[0]
+    ci_durations = [end - start for start, end in utilization.ci_runs]
+    days = (utilization.samples[-1].timestamp - utilization.samples[0].timestamp + utilization.period) / 86400
+    lines = [
+        f"{len(utilization.samples)} samples at {int(utilization.period)}s over {days:.1f} days, "
+        f"{utilization.running_hours_per_month():.0f} running hours a month, {len(utilization.build_samples())} during builds",
+        f"current: {current['instance_type']} with a {current['volume_size']}GB {current['volume_type']} root volume, "
+        f"${current_estimate['monthly_cost']:.2f} a month",
+    ]
+    if all(s.memory_used_percent is None for s in utilization.samples):
+        lines.append("no memory data, enable telemetry to allow recommending less memory")
+
+    if best["instance_type"] == current["instance_type"] and best["volume_type"] == current["volume_type"]:
+        lines.append("recommendation: no change")
+        return "\n".join(lines)
+
+    factor = best["build_time_factor"]
+    lines.append(
+        f"recommendation: {best['instance_type']} with a {best['volume_type']} root volume, "
+        f"build time x{factor:.2f}, ${best['monthly_cost']:.2f} a month "
+        f"({best['monthly_cost'] - current_estimate['monthly_cost']:+.2f})"
+    )
+    if ci_durations:
+        median = statistics.median(ci_durations)
+        lines.append(f"median ci run {median:.0f}s, expected {median * factor:.0f}s")
+    lines.append("")
+    lines.append("  ec2-dev:server:")
+    if best["instance_type"] != current["instance_type"]:
+        lines.append(f"    instance-type: {best['instance_type']}")
+    if best["volume_type"] != current["volume_type"]:
+        lines.append(f"    root-vol-type: {best['volume_type']}")
+    if len(candidates) > 1:
+        lines.append("")
+        lines.append("alternatives:")
+        for candidate in candidates[1:4]:
+            lines.append(
+                f"  {candidate['instance_type']:<12} build time x{candidate['build_time_factor']:.2f}, "
+                f"${candidate['monthly_cost']:.2f} a month"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stack", help="stack to read the instance id and configuration from")
+    parser.add_argument("--instance-id", help="instance to read CloudWatch metrics for, defaults to the stack's instance")
+    parser.add_argument("--region", default=os.getenv("AWS_REGION"))
+    parser.add_argument("--days", type=int, default=14, help="days of CloudWatch metrics to read")
+    parser.add_argument("--period", type=int, default=300, help="CloudWatch metric period in seconds")
+    parser.add_argument("--namespace", default="ec2-dev", help="CloudWatch namespace of the telemetry agent metrics")
+    parser.add_argument("--metrics-file", help="read a --record recording or telemetry samples.jsonl instead of CloudWatch")
+    parser.add_argument("--record", help="write the CloudWatch metrics to this file for use with --metrics-file")
+    parser.add_argument("--instance-type", help="current instance type, defaults to the stack configuration")
+    parser.add_argument("--root-vol-type", help="current root volume type, defaults to the stack configuration")
+    parser.add_argument("--root-vol-size", type=int, help="current root volume size in GB, defaults to the stack configuration")
+    parser.add_argument("--families", help="comma separated instance families to consider, e.g. m6i,c6i")
+    parser.add_argument("--specs", help="json file of instance types to [vcpus, memory GiB, baseline percent or null, USD per hour]")
+    parser.add_argument("--json", action="store_true", help="print the estimates as json")
+    args = parser.parse_args()
+
+    if args.specs:
+        with open(args.specs) as f:
+            INSTANCE_SPECS.update({name: tuple(spec) for name, spec in json.load(f).items()})
+
+    server_config = stack_server_config(args.stack) if args.stack else {}
+    if args.metrics_file:
+        utilization = Utilization.from_file(args.metrics_file)
+    else:
+        instance_id = args.instance_id
+        if instance_id is None:
+            if args.stack is None:
+                raise Exception("--stack, --instance-id or --metrics-file is required")
+            instance_id = stack_instance_id(args.stack)
+        instance = describe_instance(instance_id, args.region)
+        recording = get_metric_data(instance, args.days, args.period, args.namespace, args.region)
+        if args.record:
+            with open(args.record, "w") as f:
+                json.dump(recording, f, indent=1)
+        utilization = Utilization.from_metric_data(recording)
+
+    # Flags, then the recorded instance, then the stack configuration
+    current = {
+        "instance_type": args.instance_type or utilization.instance.get("InstanceType") or server_config.get("instance-type", DEFAULT_INSTANCE_TYPE),
+        "volume_type": args.root_vol_type or utilization.instance.get("RootVolumeType") or server_config.get("root-vol-type", DEFAULT_ROOT_VOLUME_TYPE),
+        "volume_size": int(args.root_vol_size or utilization.instance.get("RootVolumeSize") or server_config.get("root-vol-size", DEFAULT_ROOT_VOLUME_SIZE)),
+    }
+    families = set(args.families.split(",")) if args.families else None
+    current_estimate, candidates = recommend(utilization, current, families)
+
+    if args.json:
+        print(json.dumps({"current": current_estimate, "recommended": candidates[0], "alternatives": candidates[1:]}, indent=1))
+    else:
+        print(report(utilization, current, current_estimate, candidates))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"rightsize.py: {e}", file=sys.stderr)
+        sys.exit(1)
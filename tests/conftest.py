@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# aws-deploy and bin are not packages, their modules are imported by path as pulumi and the scripts do
+sys.path.insert(0, os.path.join(ROOT, "aws-deploy"))
+sys.path.insert(0, os.path.join(ROOT, "bin"))
@@ -0,0 +1,91 @@
+import os
+import subprocess
+
+import pytest
+
+import connect
+from connect import Connector, StackCache
+
+
+class FakeAws:
+    """EC2 and SSM as seen by Connector, instances maps ids to states."""
+
+    region = None
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.started = []
+
+    def describe_instance(self, instance_id):
+        if instance_id not in self.instances:
+            raise Exception(f"ec2 describe-instances failed: An error occurred (InvalidInstanceID.NotFound) "
+                            f"when calling the DescribeInstances operation: The instance ID '{instance_id}' does not exist")
+        return {"state": self.instances[instance_id], "private_ip": "10.0.0.1", "public_ip": None}
+
+    def start_instance(self, instance_id):
+        self.started.append(instance_id)
+        self.instances[instance_id] = "running"
+
+    def ssm_online(self, instance_id):
+        return True
+
+    def object_version(self, bucket, key):
+        return None
+
+
+def make_connector(tmp_path, instances, stack_instances):
+    cache = StackCache(str(tmp_path / "stacks.json"))
+    cache.put("dev", {"instance_id": "i-old", "state_version": None})
+    lookups = []
+
+    def resolve_instance(stack):
+        lookups.append(stack)
+        return stack_instances[stack]
+
+    return Connector(FakeAws(instances), cache, resolve_instance=resolve_instance, sleep=lambda seconds: None), lookups
+
+
+@pytest.mark.parametrize("instances", [{"i-old": "terminated", "i-new": "running"}, {"i-new": "running"}])
+def test_replaced_instance_is_looked_up_again(tmp_path, instances):
+    connector, lookups = make_connector(tmp_path, instances, {"dev": "i-new"})
+
+    entry = connector.ensure_running("dev", connector.resolve("dev"))
+
+    assert entry["instance_id"] == "i-new"
+    assert lookups == ["dev"]
+    assert StackCache(str(tmp_path / "stacks.json")).get("dev")["instance_id"] == "i-new"
+
+
+def test_cached_instance_is_used_while_it_exists(tmp_path):
+    connector, lookups = make_connector(tmp_path, {"i-old": "stopped"}, {"dev": "i-new"})
+
+    entry = connector.ensure_running("dev", connector.resolve("dev"))
+
+    assert entry["instance_id"] == "i-old"
+    assert connector.aws.started == ["i-old"]
+    assert lookups == []
+
+
+def test_destroyed_stack_is_looked_up_once(tmp_path):
+    connector, lookups = make_connector(tmp_path, {"i-old": "terminated"}, {"dev": "i-old"})
+
+    with pytest.raises(Exception, match="i-old of stack dev is terminated, run pulumi up"):
+        connector.ensure_running("dev", connector.resolve("dev"))
+    assert lookups == ["dev"]
+
+
+def test_open_connection_still_gets_a_proxy_command(tmp_path, monkeypatch):
+    monkeypatch.setattr(connect, "CACHE_DIR", str(tmp_path))
+    instances = {"i-old": "running"}
+    connector, lookups = make_connector(tmp_path, instances, {"dev": "i-new"})
+    os.makedirs(tmp_path / "ssh")
+    (tmp_path / "ssh" / "dev").touch()
+    connector.run = lambda command, **kwargs: subprocess.CompletedProcess(command, 0)
+    # An open connection needs no AWS calls
+    instances.clear()
+
+    command = connector.ssh_command("dev", ["uptime"])
+
+    assert f"ProxyCommand={' '.join(connect.ssm_proxy_command('i-old', None))}" in command
+    assert command[-2:] == ["ec2-user@dev", "uptime"]
+    assert lookups == []
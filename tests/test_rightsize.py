@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from rightsize import Utilization, recommend
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def test_throttled_t2_micro_moves_to_unlimited_credits_and_gp3():
+    # A --record recording of a build that used up the cpu credits, after which the
+    # t2 ran at its 10% baseline, and the gp2 burst balance
+    utilization = Utilization.from_file(os.path.join(FIXTURES, "rightsize-t2-micro.json"))
+    current = {"instance_type": "t2.micro", "volume_type": "gp2", "volume_size": 40}
+
+    current_estimate, candidates = recommend(utilization, current)
+
+    assert len(utilization.samples) == 36
+    assert [s.memory_used_percent for s in utilization.samples] == [None] * 36
+    assert current_estimate["build_time_factor"] == 1.0
+    best = candidates[0]
+    assert (best["instance_type"], best["volume_type"]) == ("t3.micro", "gp3")
+    assert best["build_time_factor"] < 0.6
+    # Without memory data less memory is never recommended
+    assert all(candidate["memory_gib"] >= 1 for candidate in candidates)
+
+
+def test_telemetry_samples():
+    utilization = Utilization.from_file(os.path.join(FIXTURES, "rightsize-t3a-medium-samples.jsonl"))
+
+    # The first sample after the agent starts has no rates
+    assert len(utilization.samples) == 24
+    assert utilization.period == pytest.approx(60, abs=0.1)
+    assert [(round(start), round(end)) for start, end in utilization.ci_runs] == [(1760004193, 1760005242)]
+    assert len(utilization.build_samples()) == 18
+    sample = utilization.samples[10]
+    assert sample.cpu_percent == pytest.approx(52.79, abs=0.01)
+    assert sample.memory_used_percent == pytest.approx(61.8, abs=0.01)
+    assert sample.iops == pytest.approx(430.82, abs=0.01)
+    assert sample.disk_busy_percent == pytest.approx(9.32, abs=0.01)
+
+
+def test_comfortable_t3a_medium_is_not_changed():
+    utilization = Utilization.from_file(os.path.join(FIXTURES, "rightsize-t3a-medium-samples.jsonl"))
+    current = {"instance_type": "t3a.medium", "volume_type": "gp3", "volume_size": 40}
+
+    current_estimate, candidates = recommend(utilization, current)
+
+    assert candidates[0] == current_estimate
+    # Half the memory would not leave headroom for the builds
+    assert "t3.small" not in [candidate["instance_type"] for candidate in candidates]
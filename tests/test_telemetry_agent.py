@@ -0,0 +1,97 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+AGENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "aws-deploy", "telemetry-agent.py")
+
+# Installed as ec2-dev-telemetry, the file name is not importable
+spec = importlib.util.spec_from_file_location("telemetry_agent", AGENT)
+telemetry = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(telemetry)
+
+
+@pytest.fixture
+def sample(tmp_path, monkeypatch):
+    """A sample taken 10 seconds after a first one, from the proc-0 and proc-1 fixtures."""
+    times = iter([1000.0, 1010.0])
+    monkeypatch.setattr(telemetry.time, "time", lambda: next(times))
+    sampler = telemetry.Sampler(os.path.join(FIXTURES, "proc-0"), str(tmp_path))
+    sampler.sample()
+    sampler.proc = os.path.join(FIXTURES, "proc-1")
+    return sampler.sample()
+
+
+def test_rates_between_samples(sample):
+    timestamp, host, disks, interfaces, containers, finished = sample
+
+    assert timestamp == 1010.0
+    assert host["cpu_user_percent"] == 20.0
+    assert host["cpu_iowait_percent"] == 10.0
+    assert host["cpu_steal_percent"] == 10.0
+    assert host["cpu_idle_percent"] == 50.0
+    assert host["memory_used_percent"] == 75.0
+    nvme = next(disk for disk in disks if disk["device"] == "nvme0n1")
+    assert nvme["disk_read_per_second"] == 100.0
+    assert nvme["disk_write_per_second"] == 100.0
+    assert nvme["disk_read_bytes_per_second"] == 20480 * 512 / 10
+    assert nvme["disk_busy_percent"] == 50.0
+    assert interfaces == [{"interface": "eth0", "net_receive_bytes_per_second": 1000.0, "net_transmit_bytes_per_second": 2000.0}]
+    assert containers == [] and finished == []
+
+
+def test_partitions_loop_devices_and_docker_interfaces_are_skipped(sample):
+    _, host, disks, interfaces, _, _ = sample
+
+    assert sorted(disk["device"] for disk in disks) == ["nvme0n1", "xvda"]
+    assert [interface["interface"] for interface in interfaces] == ["eth0"]
+    # Device and interface names are dimensions, not part of the metric names
+    assert not [name for name in host if name.startswith(("disk_", "net_"))]
+
+
+def test_emf_records_carry_device_and_interface_dimensions(sample):
+    timestamp, host, disks, interfaces, _, _ = sample
+    span = {"name": "ci", "pr": "12", "commit": "abc123", "start": 900.0, "end": 1000.0, "duration_seconds": 100.0}
+
+    records = telemetry.emf_records("ec2-dev", "i-0123", timestamp, host, disks, interfaces, [], [span])
+
+    layout = [(record["_aws"]["CloudWatchMetrics"][0]["Dimensions"], record.get("Device") or record.get("Interface") or record.get("Job"))
+              for record in records]
+    assert layout == [
+        ([["InstanceId"]], None),
+        ([["InstanceId", "Device"]], "xvda"),
+        ([["InstanceId", "Device"]], "nvme0n1"),
+        ([["InstanceId", "Interface"]], "eth0"),
+        ([["InstanceId", "Job"]], "ci"),
+    ]
+    nvme = records[2]
+    assert nvme["_aws"]["Timestamp"] == 1010000
+    assert nvme["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "ec2-dev"
+    units = {metric["Name"]: metric["Unit"] for metric in nvme["_aws"]["CloudWatchMetrics"][0]["Metrics"]}
+    assert units["disk_busy_percent"] == "Percent"
+    assert units["disk_read_bytes_per_second"] == "Bytes/Second"
+    assert units["disk_read_per_second"] == "Count/Second"
+    assert "device" not in units
+    job = records[-1]
+    assert job["_aws"]["Timestamp"] == 1000000
+    assert (job["InstanceId"], job["pr"], job["job_duration_seconds"]) == ("i-0123", "12", 100.0)
+    assert [metric["Name"] for metric in job["_aws"]["CloudWatchMetrics"][0]["Metrics"]] == ["job_duration_seconds"]
+
+
+def test_malformed_span_is_skipped(tmp_path, monkeypatch):
+    spool = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(telemetry, "SPOOL_FILE", str(spool))
+    spool.write_text(json.dumps({"name": "ci", "pr": "1"}) + "\n" + '{"name": "ci", "pr\n'
+                     + json.dumps({"name": "ci", "pr": "2"}) + "\n" + '{"name": "ci"')
+
+    spans, offset = telemetry.read_spans(0)
+    assert [span["pr"] for span in spans] == ["1", "2"]
+
+    # The last span was still being written
+    with open(spool, "a") as f:
+        f.write(', "pr": "3"}\n')
+    spans, offset = telemetry.read_spans(offset)
+    assert [span["pr"] for span in spans] == ["3"]
+    assert telemetry.read_spans(offset) == ([], offset)
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from user_data import UserData, UserDataTemplate, build, user_data_values
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_unknown_placeholder_is_rejected(tmp_path):
+    path = write(tmp_path, "script.sh", "echo {{region}} {{regoin}}\n")
+    with pytest.raises(Exception, match="unknown template variables regoin"):
+        UserDataTemplate(path, ["region"])
+
+
+def test_old_placeholder_syntax_is_rejected(tmp_path):
+    path = write(tmp_path, "script.sh", "echo {region} ${HOME}\n")
+    with pytest.raises(Exception, match=r"\{\{region\}\} instead of \{region\}"):
+        UserDataTemplate(path, ["region"])
+
+
+def test_other_double_braces_are_literal(tmp_path):
+    path = write(tmp_path, "script.sh",
+                 "docker ps --format '{{.Names}}'\n"
+                 "docker inspect -f '{{range .Mounts}}\\{{ .Source }}\\{{end}}' {{region}}\n")
+    template = UserDataTemplate(path, ["region"])
+    assert template.names == {"region"}
+    assert template.render({"region": "eu-west-1"}) == (
+        "docker ps --format '{{.Names}}'\n"
+        "docker inspect -f '{{range .Mounts}}{{ .Source }}{{end}}' eu-west-1\n"
+    )
+
+
+def test_render_is_deterministic(tmp_path):
+    script = write(tmp_path, "script.sh", "#!/bin/bash\necho {{region}}\n")
+    unit = write(tmp_path, "unit.service", "[Service]\nEnvironment=REGION={{region}}\n")
+
+    def render():
+        user_data = UserData(["region"])
+        user_data.add_file("/etc/systemd/system/unit.service", unit)
+        user_data.add_script(script)
+        return user_data.render({"region": "eu-west-1"})
+
+    first = render()
+    assert first == render()
+    # gzip header mtime is zero
+    assert first[4:8] == b"\0\0\0\0"
+
+
+def test_oversized_user_data_raises(tmp_path):
+    # Random hex only compresses to about half its size
+    script = write(tmp_path, "script.sh", "#!/bin/bash\n# " + os.urandom(40000).hex() + "\n")
+    user_data = UserData([])
+    user_data.add_script(script)
+    with pytest.raises(Exception, match="exceeding the EC2 limit of 16384 bytes"):
+        user_data.render({})
+
+
+def test_build_adds_unit_files_for_enabled_features(tmp_path):
+    script = write(tmp_path, "script.sh", "#!/bin/bash\necho {{region}} {{config_bucket}}\n")
+    values = user_data_values(region="eu-west-1", build_cache={}, telemetry={"interval": 30})
+    paths = [dest for dest, *_ in build(values, script).files]
+    assert paths == [
+        "/etc/systemd/system/ec2-dev-cache-restore.service",
+        "/etc/systemd/system/ec2-dev-telemetry.service",
+        "/etc/logrotate.d/ec2-dev-telemetry",
+    ]
+    assert build(user_data_values(region="eu-west-1"), script).files == []